@@ -1,6 +1,9 @@
 from .dataset import *
 from .decorators import *
 from .explainer import *
+from .bitmap_index import BitmapIndex
+from .prediction_cache import PredictionCache
+from . import encoding
 from . import transfer
 from . import transfer_functions
 from . import utils
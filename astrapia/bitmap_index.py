@@ -0,0 +1,105 @@
+import numpy as np
+
+_POPCOUNT = np.array([bin(byte).count('1') for byte in range(256)], dtype=np.uint8)
+
+
+class BitmapIndex:
+    """
+    Inverted index over the rows of an ordinal encoded dataset. Every row set is a bitmap with one bit per row,
+    packed into bytes, so that conjunctions of predicates are byte-wise intersections and set sizes are popcounts.
+
+    Features with few distinct values get one bitmap per value. For features with more distinct values, equality
+    queries are answered from a sorted copy of the column instead. Features with discretized bins additionally get
+    one bitmap per bin holding all rows up to that bin, so that every range of bins is a single intersection.
+    """
+
+    def __init__(self, data: np.ndarray, discretized: np.ndarray = None, binned_features: list = None,
+                 max_bitmap_values: int = 64):
+        """
+        :param data: ordinal encoded data, one row per instance
+        :param discretized: bin indices of the data, same shape as data, None if no feature is binned
+        :param binned_features: indices of the features whose bins should be indexed
+        :param max_bitmap_values: maximum number of distinct values of a feature that are indexed with bitmaps
+        """
+        data = np.asarray(data, dtype=float)
+        self.size = data.shape[0]
+        self.full = self.pack(np.ones(self.size, dtype=bool))
+
+        self.value_bitmaps = {}
+        self.sorted_values = {}
+        for feature in range(data.shape[1]):
+            values, inverse = np.unique(data[:, feature], return_inverse=True)
+            if len(values) <= max_bitmap_values:
+                self.value_bitmaps[feature] = {value: self.pack(inverse == code)
+                                               for code, value in enumerate(values.tolist())}
+            else:
+                order = np.argsort(data[:, feature], kind='stable')
+                self.sorted_values[feature] = (data[order, feature], order)
+
+        self.bin_bitmaps = {}
+        for feature in binned_features or []:
+            bins = np.asarray(discretized[:, feature], dtype=int)
+            self.bin_bitmaps[feature] = [self.pack(bins <= upper) for upper in range(bins.max(initial=0) + 1)]
+
+    def pack(self, mask: np.ndarray) -> np.ndarray:
+        """
+        Converts a boolean row mask into a bitmap
+
+        :param mask: boolean numpy array with one entry per row
+        :return: packed bitmap
+        """
+        return np.packbits(np.asarray(mask, dtype=bool))
+
+    def rows(self, bitmap: np.ndarray) -> np.ndarray:
+        """
+        Returns the indices of the rows contained in a bitmap
+
+        :param bitmap: packed bitmap
+        :return: sorted row indices as numpy array
+        """
+        return np.flatnonzero(np.unpackbits(bitmap, count=self.size))
+
+    @staticmethod
+    def count(bitmap: np.ndarray) -> int:
+        """
+        Returns the number of rows contained in a bitmap
+
+        :param bitmap: packed bitmap
+        :return: number of rows
+        """
+        if hasattr(np, 'bitwise_count'):
+            return int(np.bitwise_count(bitmap).sum(dtype=np.int64))
+        return int(_POPCOUNT[bitmap].sum(dtype=np.int64))
+
+    def equal(self, feature: int, value: float) -> np.ndarray:
+        """
+        Returns the rows whose feature has the given value
+
+        :param feature: index of the feature
+        :param value: encoded value
+        :return: packed bitmap
+        """
+        value = float(value)
+        if feature in self.value_bitmaps:
+            bitmap = self.value_bitmaps[feature].get(value)
+            return bitmap if bitmap is not None else np.zeros_like(self.full)
+
+        values, order = self.sorted_values[feature]
+        mask = np.zeros(self.size, dtype=bool)
+        mask[order[np.searchsorted(values, value, side='left'):np.searchsorted(values, value, side='right')]] = True
+        return self.pack(mask)
+
+    def bin_range(self, feature: int, lower: int = None, upper: int = None) -> np.ndarray:
+        """
+        Returns the rows whose bin of the feature lies in the half-open range (lower, upper]
+
+        :param feature: index of a binned feature
+        :param lower: exclusive lower bin, None for no lower bound
+        :param upper: inclusive upper bin, None for no upper bound
+        :return: packed bitmap
+        """
+        bitmaps = self.bin_bitmaps[feature]
+        bitmap = self.full if upper is None or upper >= len(bitmaps) else bitmaps[upper]
+        if lower is not None and lower >= 0:
+            bitmap = bitmap & ~bitmaps[min(lower, len(bitmaps) - 1)]
+        return bitmap
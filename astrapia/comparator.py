@@ -1,5 +1,7 @@
 import json
-from collections import defaultdict
+import multiprocessing
+import os
+import random as py_random
 from datetime import datetime
 
 import numpy as np
@@ -9,6 +11,109 @@ from tqdm import tqdm
 import astrapia as xb
 from astrapia.samplers import base_sampler, random, splime
 
+# explainers, instances, report options and metric plans of the running explain_instances call. Set in the parent
+# process right before the worker pool is forked, so that the workers inherit the fitted explainers copy-on-write.
+_worker_context = None
+
+
+def _cell_seed(random_state, explainer_idx, index):
+    """
+    Derive a deterministic seed for a single (explainer, instance) cell
+
+    :param random_state: base seed or None
+    :param explainer_idx: position of the explainer in the comparator
+    :param index: position of the instance, None for the seed of the intermediates shared by all instances
+        (see Explainer.warm_up)
+    :return: seed as int or None if no base seed is given
+    """
+    if random_state is None:
+        return None
+    if index is None:
+        # a spawn key keeps the stream apart from the cells, trailing zeros of the entropy would not
+        sequence = np.random.SeedSequence([random_state, explainer_idx], spawn_key=(1,))
+    else:
+        sequence = np.random.SeedSequence([random_state, explainer_idx, index])
+    return int(sequence.generate_state(1)[0])
+
+
+def _report_metrics(explainer, metrics, inferred_metrics, approximate):
+    """
+    Compute the given metrics of the current explanation of an explainer
+
+    :return: dictionary with key: name of metric, value: metric value, without metrics that are not defined
+    """
+    explanation_metrics = {}
+    for (metric, value) in explainer.report(tag='metric', inferred_metrics=inferred_metrics,
+                                            approximate=approximate, metrics=metrics):
+        if not np.isnan(value):
+            explanation_metrics[metric] = value
+    return explanation_metrics
+
+
+def _explain_cell(cell):
+    """
+    Explain a single instance with a single explainer and compute its planned metrics
+
+    :param cell: tuple of explainer position, instance position, seed and whether it runs in a worker
+    :return: tuple of explainer position, instance position, explanation and metrics
+    """
+    explainer_idx, index, seed, in_worker = cell
+    explainers, instances, inferred_metrics, approximate, plans = _worker_context
+    explainer, plan = explainers[explainer_idx], plans[explainer_idx]
+
+    if seed is not None:
+        np.random.seed(seed)
+        py_random.seed(seed)
+
+    explanation = explainer.explain_instance(instances.iloc[[index]])
+    explanation_metrics = _report_metrics(explainer, plan['metrics'], inferred_metrics, approximate)
+
+    if in_worker:
+        explanation = explainer.detach_explanation(explanation)
+
+    return explainer_idx, index, explanation, explanation_metrics
+
+
+def _run_cells(function, cells, n_jobs, pbar):
+    """
+    Run a function on all cells, in a pool of forked worker processes if n_jobs > 1
+
+    :return: generator of the results in the order they are finished
+    """
+    if n_jobs > 1:
+        # workers are forked after the context is set, so they inherit the fitted explainers
+        with multiprocessing.get_context('fork').Pool(processes=min(n_jobs, len(cells) or 1)) as pool:
+            for result in pool.imap_unordered(function, cells):
+                pbar.update(1)
+                yield result
+    else:
+        for cell in cells:
+            result = function(cell)
+            pbar.update(1)
+            yield result
+
+
+def _average_metrics(aggregated_explainer_metrics):
+    """
+    Average the metrics of all explanations of one explainer
+
+    :param aggregated_explainer_metrics: dictionary with key: index of explanation, value: dictionary of metrics
+    :return: dictionary with key: name of metric, value: average value
+    """
+    all_explainers = [x.keys() for x in aggregated_explainer_metrics.values()]
+    relevant_metrics = list(set([item for sublist in all_explainers for item in sublist]))
+    expam = {}
+    for metric in relevant_metrics:
+        aggregation = 0
+        count = 0
+        for metrics in aggregated_explainer_metrics.values():
+            if metric in metrics.keys():
+                count += 1
+                aggregation += metrics[metric]
+        if count > 0:
+            expam[metric] = aggregation / count
+    return expam
+
 
 class ExplainerComparator:
     """
@@ -16,10 +121,17 @@ class ExplainerComparator:
     different explainers
     """
 
-    def __init__(self):
+    def __init__(self, prediction_cache: xb.PredictionCache = None):
+        """
+        :param prediction_cache: optional prediction cache that replaces the prediction function of every added
+            explainer, so that all explainers share the predictions of the model
+        """
         # Dictionary with key: name of explainer, value: explainer as object
         self.explainers = {}
 
+        # Prediction cache shared by all explainers
+        self.prediction_cache = prediction_cache
+
         # Dictionary with key: name of explainer, value: dictionary with key: name of property, value: property
         self.properties = {}
 
@@ -40,15 +152,24 @@ class ExplainerComparator:
         # timestamp of the creation of metrics
         self.timestamp = ''
 
+        # Dictionary with key: name of explainer, value: metric plan of the last explain_instances call
+        self.plan = {}
+
     def add_explainer(self, explainer: xb.Explainer, name: str):
         """
         Add an instantiated explainer to the comparator. Use the name attribute for uniquely identifying different
         explainers (E.g. between 'Anchors acc>95%' and 'Anchors acc>85%')
 
+        If the comparator holds a prediction cache, the prediction function of the explainer is replaced by it.
+        The cache has to wrap the same model the explainer was initialized with.
+
         :param explainer: explainer object
         :param name: unique name for identifying the explainer
         """
 
+        if self.prediction_cache is not None:
+            explainer.predict = self.prediction_cache
+
         explainer_properties = {}
         for (prop, value) in explainer.report(tag='prop', inferred_metrics=False):
             explainer_properties[prop] = value
@@ -56,12 +177,70 @@ class ExplainerComparator:
         self.explainers[name] = explainer
         self.properties[name] = explainer_properties
 
-    def explain_instances(self, instances: pd.DataFrame, inferred_metrics=False):
+    def plan_metrics(self, count: int, metrics: list = None, max_cost: str = None, inferred_metrics=False,
+                     approximate: float = None) -> dict:
+        """
+        Plans the metrics every explainer computes when explaining a number of instances. All metrics are computed
+        right after every explanation, while it is still in place. Cheap metrics only need the explanation. The
+        intermediates that metrics needing the model or a full pass over the training set share, e.g. the model
+        predictions of the training set, are computed in one batch before the first explanation
+        (see Explainer.warm_metrics).
+
+        :param count: number of instances
+        :param metrics: names of the metrics to compute, None for all metrics
+        :param max_cost: most expensive cost of the metrics to compute, see astrapia.decorators.COSTS
+        :param inferred_metrics: whether to include inferred metrics
+        :param approximate: half-width at which the metrics are approximated, None to compute them exactly
+        :return: dictionary with key: name of explainer, value: dictionary with the names of the 'metrics' and the
+            'model_calls' budget, i.e. the calls the explanations need (see Explainer.explanation_model_calls) plus
+            the calls the metrics need (see Explainer.metric_model_calls)
+        """
+        if max_cost is not None and max_cost not in xb.COSTS:
+            raise ValueError(f'max_cost should be one of {xb.COSTS}, not {max_cost!r}')
+
+        plans = {}
+        available = set()
+        for name, explainer in self.explainers.items():
+            costs = explainer.metric_costs(inferred_metrics)
+            available |= set(costs)
+            selected = [metric for metric, cost in sorted(costs.items())
+                        if (metrics is None or metric in metrics) and
+                        (max_cost is None or xb.COSTS.index(cost) <= xb.COSTS.index(max_cost))]
+            plans[name] = {'metrics': selected,
+                           'model_calls': explainer.explanation_model_calls(count) +
+                           explainer.metric_model_calls(selected, count, approximate)}
+
+        if metrics is not None and not set(metrics) <= available:
+            raise ValueError(f'Unknown metrics {sorted(set(metrics) - available)}')
+        return plans
+
+    def explain_instances(self, instances: pd.DataFrame, inferred_metrics=False, n_jobs: int = 1,
+                          random_state: int = None, approximate: float = None, metrics: list = None,
+                          max_cost: str = None, printing: bool = False):
         """
         Create explanations for all combinations of provided explainers and instances, then save metrics
 
+        With n_jobs > 1 the (explainer, instance) cells are spread over a pool of forked worker processes.
+        The explainers are fitted once in the parent process and inherited copy-on-write by the workers, so
+        this mode requires the 'fork' start method (Linux, macOS). Intermediates the explainers would otherwise
+        build lazily, e.g. nearest neighbor indexes and the model predictions of the training set, are built in the
+        parent process before the first explanation (see Explainer.warm_up). The explainer objects of the
+        comparator keep the state they had before the call, as the explanations are created in the workers.
+
         :param inferred_metrics: Check whether you want to include inferred metrics in the report
         :param instances: instances to be used to create explanations as pandas dataframe
+        :param n_jobs: number of worker processes, -1 uses all available cores
+        :param random_state: seed from which a deterministic seed for every (explainer, instance) cell and for the
+            intermediates shared by the cells of an explainer, e.g. a perturbation pool, is derived. If None, cells
+            are only seeded when running in parallel, using a base seed drawn from numpy's global RNG
+        :param approximate: half-width of the 95% confidence interval, e.g. 0.005 for +-0.5%, at which the metrics
+            that sum over the training set are approximated on stratified subsamples, see Explainer.report. Every
+            approximated metric is then accompanied by its standard error as '<metric>_stderr'. None computes the
+            metrics exactly.
+        :param metrics: names of the metrics to compute, None for all metrics
+        :param max_cost: most expensive cost of the metrics to compute, 'cheap', 'model' or 'scan', None for all.
+            The metric plan of every explainer is kept in the plan attribute, see plan_metrics.
+        :param printing: whether to print the model call budget before explaining
         """
 
         # Reset aggregation attributes
@@ -70,57 +249,69 @@ class ExplainerComparator:
         self.metrics = {}
         self.instances = instances
 
+        if n_jobs is None or n_jobs == 0:
+            n_jobs = 1
+        elif n_jobs < 0:
+            n_jobs = max(1, os.cpu_count() + 1 + n_jobs)
+
+        if random_state is None and n_jobs > 1:
+            # forked workers inherit the same global RNG state, so the cells need their own seeds
+            random_state = np.random.randint(np.iinfo(np.int32).max)
+
+        names = list(self.explainers.keys())
+        cells = [(explainer_idx, index, _cell_seed(random_state, explainer_idx, index), n_jobs > 1)
+                 for explainer_idx in range(len(names)) for index in range(instances.shape[0])]
+
+        self.plan = self.plan_metrics(instances.shape[0], metrics, max_cost, inferred_metrics, approximate)
+        plans = [self.plan[name] for name in names]
+        if printing:
+            print(f'model call budget: {sum(plan["model_calls"] for plan in plans)}',
+                  {name: plan['model_calls'] for name, plan in self.plan.items()})
+
+        results = {name: {} for name in names}
+
         # Initialize tqdm progress bar
-        with tqdm(total=len(self.explainers.keys()) * len(instances)) as pbar:
-
-            # Iterate over all explainers
-            for name, explainer in self.explainers.items():
-                explainer_average_metrics = defaultdict(float)
-                aggregated_explainer_metrics = {}
-                aggregated_explanations = {}
-
-                # iterate over all instances
-                for index in range(instances.shape[0]):
-                    explanation = explainer.explain_instance(instances.iloc[[index]])
-
-                    explanation_metrics = {}
-                    for (metric, value) in explainer.report(tag='metric', inferred_metrics=inferred_metrics):
-                        if not np.isnan(value):
-                            explanation_metrics[metric] = value
-
-                    aggregated_explainer_metrics[str(index)] = explanation_metrics
-                    aggregated_explanations[str(index)] = explanation
-
-                    # update progress bar
-                    pbar.update(1)
-
-                # computing average metrics
-                all_explainers = [x.keys() for x in aggregated_explainer_metrics.values()]
-                relevant_metrics = list(set([item for sublist in all_explainers for item in sublist]))
-                expam = {}
-                for metric in relevant_metrics:
-                    aggregation = 0
-                    count = 0
-                    for metrics in aggregated_explainer_metrics.values():
-                        if metric in metrics.keys():
-                            count += 1
-                            aggregation += metrics[metric]
-                    if count > 0:
-                        expam[metric] = aggregation / count
-
-                self.averaged_metrics[name] = expam
-                self.metrics[name] = aggregated_explainer_metrics
-                self.explanations[name] = aggregated_explanations
-            self.timestamp = str(datetime.now())
+        with tqdm(total=len(cells)) as pbar:
+            global _worker_context
+            explainers = [self.explainers[name] for name in names]
+            for explainer_idx, (explainer, plan) in enumerate(zip(explainers, plans)):
+                # the shared intermediates are computed in one batch before the first explanation, in the parent, as
+                # forked workers would each rebuild and lose them. They are seeded apart from the cells, so that
+                # serial and parallel runs sample the same ones.
+                explainer.warm_up(_cell_seed(random_state, explainer_idx, None))
+                explainer.warm_metrics(plan['metrics'], approximate)
+            _worker_context = (explainers, instances, inferred_metrics, approximate, plans)
+            try:
+                for explainer_idx, index, explanation, explanation_metrics in _run_cells(
+                        _explain_cell, cells, n_jobs, pbar):
+                    if n_jobs > 1:
+                        explanation = explainers[explainer_idx].attach_explanation(explanation)
+                    results[names[explainer_idx]][index] = (explanation, explanation_metrics)
+            finally:
+                _worker_context = None
+
+        for name in names:
+            aggregated_explainer_metrics = {}
+            aggregated_explanations = {}
+            for index in range(instances.shape[0]):
+                explanation, explanation_metrics = results[name][index]
+                aggregated_explainer_metrics[str(index)] = explanation_metrics
+                aggregated_explanations[str(index)] = explanation
+
+            self.averaged_metrics[name] = _average_metrics(aggregated_explainer_metrics)
+            self.metrics[name] = aggregated_explainer_metrics
+            self.explanations[name] = aggregated_explanations
+        self.timestamp = str(datetime.now())
 
     def explain_representative(self, data: xb.Dataset, sampler: str = 'splime', count: int = 10, pred_fn=None,
-                               return_samples: bool = False, inferred_metrics=False, **kwargs):
+                               return_samples: bool = False, inferred_metrics=False, n_jobs: int = 1, **kwargs):
         """
         Create a representative explanation for the given data
 
         :param inferred_metrics: Check whether you want to include inferred metrics in the report
+        :param n_jobs: number of worker processes used to explain the samples, see explain_instances
         :param return_samples: Check whether sampled elements should be returned
-        :param pred_fn: Provide optional prediction function for sampling
+        :param pred_fn: Provide optional prediction function for sampling, defaults to the prediction cache
         :param data: pandas dataframe with the data to be explained
         :param sampler: sampler to be used to create representative explanation
         :param count: amount of representative samples to be created
@@ -143,12 +334,15 @@ class ExplainerComparator:
             # sampler is unknown
             raise NameError('Invalid sampler \'' + sampler + '\'')
 
+        if pred_fn is None:
+            pred_fn = self.prediction_cache
+
         # sampler is now a Sampler object
         # sample instances and explain them
         instances = sampler.sample(data, count, pred_fn, **kwargs)
 
         # relay the samples instances to the regular explain_instances function
-        self.explain_instances(instances, inferred_metrics=inferred_metrics)
+        self.explain_instances(instances, inferred_metrics=inferred_metrics, n_jobs=n_jobs)
 
         if return_samples:
             return instances
@@ -5,6 +5,8 @@ import pandas as pd
 from numpy.random import RandomState
 from sklearn.utils import Bunch
 
+from astrapia.encoding import OneHotCodec, OrdinalCodec
+
 
 def load_csv_data(dataset_name, root_path='data', seed=0):
     """
@@ -129,5 +131,9 @@ class Dataset(Bunch):
             data_dev=data_dev,
             target_dev=target_dev,
             data_test=data_test,
-            target_test=target_test
+            target_test=target_test,
+            # fitted one-hot encoding of the features, shared by all explainers working on one-hot encoded data
+            onehot=OneHotCodec(data.columns, categorical_features),
+            # fitted ordinal encoding of the features, used by explainers working on label indices
+            ordinal=OrdinalCodec(data.columns, categorical_features)
         )
@@ -1,8 +1,29 @@
-def metric(fn):
+import functools
+
+
+# costs of metrics from cheapest to most expensive: 'cheap' metrics are derived from the state of the explanation,
+# 'model' metrics need model predictions and 'scan' metrics additionally pass over the full training set
+COSTS = ('cheap', 'model', 'scan')
+
+# how approximate metrics are estimated from a subsample of the training set: 'total' metrics sum over the training
+# set and are estimated from a subsample shared by all explanations, 'ratio' metrics are weighted averages over the
+# neighborhood of an explanation and are estimated from a subsample of that neighborhood
+ESTIMATORS = ('total', 'ratio')
+
+
+def metric(fn=None, cost='cheap', estimator=None):
     """Decorator for tagging metrics.
 
-    Metrics can be used to compare different explainers.
+    Metrics can be used to compare different explainers. Use as ``@metric`` or ``@metric(cost='model')`` to
+    annotate how expensive the metric is, one of COSTS. Metrics that sum over the training set name how they are
+    approximated on a subsample with one of ESTIMATORS, all other metrics are always computed exactly.
     """
+    if cost not in COSTS:
+        raise ValueError(f'cost should be one of {COSTS}, not {cost!r}')
+    if estimator is not None and estimator not in ESTIMATORS:
+        raise ValueError(f'estimator should be one of {ESTIMATORS} or None, not {estimator!r}')
+    if fn is None:
+        return functools.partial(metric, cost=cost, estimator=estimator)
 
     def wrapper(*args):
         result = fn(*args)
@@ -11,6 +32,8 @@ def metric(fn):
         return result
 
     wrapper.tag = 'metric'
+    wrapper.cost = cost
+    wrapper.estimator = estimator
     return wrapper
 
 
@@ -46,3 +69,22 @@ def prop(fn):
 
     wrapper.tag = 'prop'
     return wrapper
+
+
+def per_explanation(fn):
+    """Decorator for memoizing intermediates of the current explanation.
+
+    The result of the decorated method is computed on first use and shared by all metrics, utilities and transfer
+    functions until the explainer holds another explanation or its metrics are restricted to another subsample.
+    """
+
+    @functools.wraps(fn)
+    def wrapper(self):
+        explanation, sample = self.__dict__.get('explanation'), self.__dict__.get('sample')
+        memo = self.__dict__.setdefault('_per_explanation', {})
+        entry = memo.get(fn.__name__)
+        if entry is None or entry[0] is not explanation or entry[1] is not sample:
+            entry = memo[fn.__name__] = (explanation, sample, fn(self))
+        return entry[2]
+
+    return wrapper
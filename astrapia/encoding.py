@@ -0,0 +1,186 @@
+import numpy as np
+import pandas as pd
+
+
+class OneHotCodec:
+    """
+    Fitted one-hot encoding between the Astrapia Dataset format and the one-hot encoded format used by the
+    LIME-based explainers. Column order, column indices and label vocabularies are computed once, so that encoding
+    and decoding only consist of vectorized numpy operations.
+
+    The encoded format consists of the continuous features in the order of the dataset, followed by one column
+    per label of every categorical feature, named feature_label.
+    """
+
+    def __init__(self, feature_names: list, categorical_features: dict):
+        """
+        :param feature_names: names of all features in the order of the dataset
+        :param categorical_features: dictionary mapping categorical feature names to their list of labels
+        """
+        self.feature_names = list(feature_names)
+        self.categorical_features = {feature: list(categorical_features[feature]) for feature in
+                                     categorical_features if feature in self.feature_names}
+        self.continuous_features = [feature for feature in self.feature_names
+                                    if feature not in self.categorical_features]
+
+        self.columns = list(self.continuous_features)
+        self.offsets = {}
+        self.labels = {}
+        self.label_indices = {}
+        for feature, labels in self.categorical_features.items():
+            self.offsets[feature] = len(self.columns)
+            self.columns += [feature + '_' + str(label) for label in labels]
+            self.labels[feature] = np.empty(len(labels), dtype=object)
+            self.labels[feature][:] = labels
+            self.label_indices[feature] = pd.Index(labels)
+
+        self.continuous_indices = {feature: idx for idx, feature in enumerate(self.continuous_features)}
+        self._label_lookup = {feature: {label: idx for idx, label in enumerate(labels)}
+                              for feature, labels in self.categorical_features.items()}
+
+    def encode_array(self, data: pd.DataFrame) -> np.ndarray:
+        """
+        One-hot encodes a DataFrame in the Astrapia Dataset format
+
+        :param data: DataFrame in the Astrapia Dataset format
+        :return: float matrix with the encoded columns
+        """
+        encoded = np.zeros((data.shape[0], len(self.columns)))
+        encoded[:, :len(self.continuous_features)] = data[self.continuous_features].to_numpy(dtype=float)
+
+        rows = np.arange(data.shape[0])
+        for feature, offset in self.offsets.items():
+            codes = self.label_indices[feature].get_indexer(data[feature])
+            known = codes >= 0
+            encoded[rows[known], offset + codes[known]] = 1
+        return encoded
+
+    def encode(self, data: pd.DataFrame) -> pd.DataFrame:
+        """
+        One-hot encodes a DataFrame in the Astrapia Dataset format
+
+        :param data: DataFrame in the Astrapia Dataset format
+        :return: one-hot encoded DataFrame with the same index
+        """
+        return pd.DataFrame(self.encode_array(data), columns=self.columns, index=data.index)
+
+    def encode_row(self, instance) -> np.ndarray:
+        """
+        Fast path to one-hot encode a single instance without building intermediate DataFrames
+
+        :param instance: single-row DataFrame, Series or dictionary in the Astrapia Dataset format
+        :return: encoded instance as one-dimensional numpy array
+        """
+        if isinstance(instance, pd.DataFrame):
+            instance = dict(zip(instance.columns, instance.to_numpy()[0]))
+
+        encoded = np.zeros(len(self.columns))
+        for idx, feature in enumerate(self.continuous_features):
+            encoded[idx] = instance[feature]
+        for feature, offset in self.offsets.items():
+            idx = self._label_lookup[feature].get(instance[feature])
+            if idx is not None:
+                encoded[offset + idx] = 1
+        return encoded
+
+    def decode(self, data) -> pd.DataFrame:
+        """
+        Decodes one-hot encoded data into the Astrapia Dataset format. Every categorical feature takes the label
+        of its highest column.
+
+        :param data: one-hot encoded DataFrame or numpy array with columns in the order of the codec
+        :return: DataFrame in the Astrapia Dataset format
+        """
+        index = None
+        if isinstance(data, pd.DataFrame):
+            index = data.index
+            data = data[self.columns].to_numpy(dtype=float)
+        data = np.asarray(data, dtype=float).reshape((-1, len(self.columns)))
+
+        decoded = {}
+        for feature in self.feature_names:
+            if feature in self.offsets:
+                offset = self.offsets[feature]
+                block = data[:, offset:offset + len(self.labels[feature])]
+                decoded[feature] = self.labels[feature].take(block.argmax(axis=1))
+            else:
+                decoded[feature] = data[:, self.continuous_indices[feature]]
+        return pd.DataFrame(decoded, index=index, columns=self.feature_names)
+
+
+class OrdinalCodec:
+    """
+    Fitted ordinal encoding between the Astrapia Dataset format and the integer-coded format used by Anchors.
+    Categorical features are replaced by the index of their label, continuous features are kept as they are.
+    The label vocabularies are computed once, so that encoding and decoding do not need Python callbacks per value.
+    """
+
+    def __init__(self, feature_names: list, categorical_features: dict):
+        """
+        :param feature_names: names of all features in the order of the dataset
+        :param categorical_features: dictionary mapping categorical feature names to their list of labels
+        """
+        self.feature_names = list(feature_names)
+        self.categorical_indices = [idx for idx, feature in enumerate(self.feature_names)
+                                    if feature in categorical_features]
+        self.continuous_indices = [idx for idx, feature in enumerate(self.feature_names)
+                                   if feature not in categorical_features]
+
+        self.labels = {}
+        self.label_indices = {}
+        self.label_name_indices = {}
+        for idx in self.categorical_indices:
+            labels = list(categorical_features[self.feature_names[idx]])
+            self.labels[idx] = np.empty(len(labels), dtype=object)
+            self.labels[idx][:] = labels
+            self.label_indices[idx] = pd.Index(labels)
+            self.label_name_indices[idx] = pd.Index([str(label) for label in labels])
+
+    def codes(self, idx: int, values) -> np.ndarray:
+        """
+        Maps the values of a categorical feature to the indices of their labels. Values are matched by equality
+        first and by their string representation second.
+
+        :param idx: index of the categorical feature
+        :param values: values of the feature
+        :return: integer codes
+        """
+        values = pd.Series(values)
+        codes = self.label_indices[idx].get_indexer(values)
+        unknown = codes < 0
+        if unknown.any():
+            codes[unknown] = self.label_name_indices[idx].get_indexer(values[unknown].astype(str))
+            if (codes < 0).any():
+                raise ValueError(f'Unknown label {values[codes < 0].iloc[0]!r} of feature '
+                                 f'{self.feature_names[idx]!r}')
+        return codes
+
+    def encode(self, data: pd.DataFrame) -> np.ndarray:
+        """
+        Ordinal encodes a DataFrame in the Astrapia Dataset format
+
+        :param data: DataFrame in the Astrapia Dataset format
+        :return: float matrix with label indices for categorical features
+        """
+        encoded = np.empty((data.shape[0], len(self.feature_names)))
+        continuous = [self.feature_names[idx] for idx in self.continuous_indices]
+        encoded[:, self.continuous_indices] = data[continuous].to_numpy(dtype=float)
+        for idx in self.categorical_indices:
+            encoded[:, idx] = self.codes(idx, data[self.feature_names[idx]].to_numpy())
+        return encoded
+
+    def decode(self, data: np.ndarray) -> pd.DataFrame:
+        """
+        Decodes an ordinal encoded matrix into the Astrapia Dataset format
+
+        :param data: matrix with label indices for categorical features
+        :return: DataFrame in the Astrapia Dataset format
+        """
+        data = np.asarray(data)
+        decoded = {}
+        for idx, feature in enumerate(self.feature_names):
+            if idx in self.labels:
+                decoded[feature] = self.labels[idx].take(data[:, idx].astype(int))
+            else:
+                decoded[feature] = data[:, idx].astype(float)
+        return pd.DataFrame(decoded, columns=self.feature_names)
@@ -1,3 +1,6 @@
+import contextlib
+
+import numpy as np
 import pandas as pd
 
 import astrapia as xb
@@ -8,8 +11,29 @@ class Explainer:
     The Explainer class wraps an explainer and provides a unified interface for it.
     Initialization depends on the specific explainer.
     This class should *not* be used as is but rather extended.
+
+    The names of the metrics, properties and utilities of every subclass are collected once when the class is
+    defined, so that reports do not have to inspect all attributes of the class hierarchy. Tagged functions that
+    are attached to an explainer object are found as well, tagged functions assigned to a class after its
+    definition are not.
     """
 
+    # name -> tag of the tagged methods of the class, in the order of their definition along the class hierarchy
+    tag_registry = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        registry = {}
+        for klass in reversed(cls.__mro__):
+            for name, value in vars(klass).items():
+                tag = getattr(value, 'tag', None)
+                if tag is not None:
+                    registry[name] = tag
+                else:
+                    # overridden by an untagged attribute
+                    registry.pop(name, None)
+        cls.tag_registry = registry
+
     def __init__(self):
         """
         Extend this class and override this method to define your explainer
@@ -45,13 +69,115 @@ class Explainer:
         """
         raise NotImplementedError
 
+    def detach_explanation(self, explanation: any) -> any:
+        """
+        Prepares an explanation to be sent to another process, e.g. by dropping references to the explainer that
+        cannot be pickled. Override together with attach_explanation if the explanations of your explainer
+        are not picklable.
+
+        :param explanation: explanation as returned by explain_instance
+        :return: a picklable explanation
+        """
+        return explanation
+
+    def attach_explanation(self, explanation: any) -> any:
+        """
+        Reverts detach_explanation after an explanation was received from another process
+
+        :param explanation: explanation as returned by detach_explanation
+        :return: the explanation
+        """
+        return explanation
+
+    def predict_train(self, rows: np.ndarray = None) -> any:
+        """
+        Predicts the training set or some of its rows with the model of the explainer.
+        Override to support metrics that need the model predictions of the training set.
+
+        :param rows: sorted index array of training rows, None for all rows
+        :return: predictions of the rows
+        """
+        raise NotImplementedError
+
+    def get_train_predictions(self, rows=None) -> any:
+        """
+        Returns the model predictions of the training set or of some of its rows as returned by predict_train.
+        They do not depend on the explained instance, so every row is predicted once and shared by all metrics until
+        the prediction function of the explainer (its predict attribute) is replaced. Rows that are requested by
+        index are predicted as they are requested, unless the whole training set has been predicted already.
+
+        :param rows: slice or sorted index array of training rows, None for all rows
+        :return: predictions of the rows
+        """
+        if self.__dict__.get('_train_predictions_fn') is not self.predict:
+            self._train_predictions = None
+            self._predicted_rows, self._row_predictions = np.empty(0, dtype=np.int64), None
+            self._train_predictions_fn = self.predict
+        if self._train_predictions is None and (rows is None or isinstance(rows, slice)):
+            self._train_predictions = self.predict_train()
+        if self._train_predictions is not None:
+            return self._train_predictions if rows is None else self._train_predictions[rows]
+
+        missing = np.setdiff1d(rows, self._predicted_rows)
+        if len(missing) > 0:
+            predictions = np.asarray(self.predict_train(missing))
+            if self._row_predictions is not None:
+                predictions = np.concatenate([self._row_predictions, predictions])
+            merged = np.concatenate([self._predicted_rows, missing])
+            order = np.argsort(merged, kind='stable')
+            self._predicted_rows, self._row_predictions = merged[order], predictions[order]
+        return self._row_predictions[np.searchsorted(self._predicted_rows, rows)]
+
+    def warm_up(self, seed: int = None) -> None:
+        """
+        Computes the intermediates that all explanations share and that the first explanation would otherwise build
+        lazily, e.g. a nearest neighbor index of the training set. The comparator calls it in the parent process
+        before the first explanation, so that forked workers inherit them instead of rebuilding them each.
+        Override if your explainer builds such intermediates.
+
+        :param seed: seed of the intermediates that are sampled at random, None to sample them from the random state
+            of the explainer
+        """
+
+    def tagged(self, *tags) -> list:
+        """
+        Returns the names of the attributes with one of the given tags, the tagged methods of the class followed by
+        the tagged functions attached to the explainer object, e.g. the metrics inferred by transfer functions.
+        An untagged attribute of the explainer object, e.g. None, hides the tagged method of the same name.
+
+        :param tags: 'metric', 'prop' or 'utility'
+        :return: a list of attribute names
+        """
+        registry = type(self).tag_registry
+        instance_tags = {}
+        for name, value in vars(self).items():
+            # only callables can be tagged, which avoids looking up tags on e.g. DataFrames
+            tag = getattr(value, 'tag', None) if callable(value) else None
+            if tag is not None or name in registry:
+                instance_tags[name] = tag
+        if instance_tags:
+            registry = {**registry, **instance_tags}
+        return [name for name, tag in registry.items() if tag in tags]
+
+    def add_tagged(self, name: str, fn) -> None:
+        """
+        Attaches a tagged function to this explainer, e.g. a metric inferred by a transfer function.
+        Equivalent to setting the attribute directly.
+
+        :param name: name of the attribute
+        :param fn: function decorated with metric, prop or utility
+        """
+        setattr(self, name, fn)
+
     def metrics(self) -> list:
         """
-        Returns a list of metrics that are available for this explainer
+        Returns a list of metrics that are available for this explainer. Metrics are the methods of the class that
+        are decorated with metric and the metric functions attached to the explainer object. A metric assigned to
+        the class after its definition is not found, attach it to the explainer with add_tagged instead.
 
         :return: a list of metric references
         """
-        return [x for x in dir(self) if getattr(getattr(self, x), 'tag', None) == 'metric']
+        return self.tagged('metric')
 
     def props(self) -> list:
         """
@@ -59,7 +185,100 @@ class Explainer:
 
         :return: a list of property references
         """
-        return [x for x in dir(self) if getattr(getattr(self, x), 'tag', None) == 'prop']
+        return self.tagged('prop')
+
+    def metric_functions(self, inferred_metrics=True) -> dict:
+        """
+        Returns the metric functions of this explainer
+
+        :param inferred_metrics: whether to include the metrics inferred by transfer functions
+        :return: dictionary with key: name of the metric, value: metric function
+        """
+        functions = {x: getattr(self, x) for x in self.tagged('metric')}
+        if inferred_metrics:
+            functions.update(xb.transfer.resolve_transfers(self))
+        return functions
+
+    def metric_costs(self, inferred_metrics=True) -> dict:
+        """
+        Returns the cost annotation of every metric, see astrapia.decorators.COSTS
+
+        :param inferred_metrics: whether to include the metrics inferred by transfer functions
+        :return: dictionary with key: name of the metric, value: 'cheap', 'model' or 'scan'
+        """
+        return {x: f.cost for (x, f) in self.metric_functions(inferred_metrics).items()}
+
+    def get_shared_rows(self, metrics: list, approximate: float = None) -> any:
+        """
+        Returns the training rows whose model predictions the given metrics share between all explanations: all
+        rows for metrics that are computed exactly and the subsample of the training set for approximated totals.
+        Approximated ratios predict the sampled neighborhood of every explanation instead.
+
+        :param metrics: names of the metrics
+        :param approximate: half-width at which the metrics are approximated, None to compute them exactly
+        :return: None for all rows, a sorted index array of rows or False if no predictions are shared
+        """
+        functions = self.metric_functions()
+        expensive = [functions[metric] for metric in metrics if metric in functions and
+                     functions[metric].cost != 'cheap']
+        if approximate is None and expensive or any(f.estimator is None for f in expensive):
+            return None
+        if any(f.estimator == 'total' for f in expensive):
+            sample = self.get_metric_sample(approximate)
+            return None if sample is None else sample[0][0]
+        return False
+
+    def explanation_model_calls(self, explanations: int = 1) -> int:
+        """
+        Returns the number of calls of the prediction function the explanations themselves need, one per
+        explanation by default. Override if your explanations call the model a known number of times.
+
+        :param explanations: number of explanations
+        :return: number of model calls
+        """
+        return explanations
+
+    def metric_model_calls(self, metrics: list, explanations: int = 1, approximate: float = None) -> int:
+        """
+        Returns the number of calls of the prediction function the given metrics need besides the explanations.
+        Metrics that are not cheap share the model predictions of the training set or its subsample
+        (see get_shared_rows), so they need one call until the predictions are cached. Approximated ratios need up
+        to one more call per explanation for the rows of its neighborhood sample that were not predicted before.
+
+        :param metrics: names of the metrics
+        :param explanations: number of explanations the metrics are computed for
+        :param approximate: half-width at which the metrics are approximated, None to compute them exactly
+        :return: number of model calls
+        """
+        cached = self.__dict__.get('_train_predictions_fn') is self.predict
+        if type(self).predict_train is Explainer.predict_train or cached and self._train_predictions is not None:
+            return 0
+        functions = self.metric_functions()
+        calls = 0
+        if approximate is not None and any(functions[metric].estimator == 'ratio' and
+                                           functions[metric].cost != 'cheap'
+                                           for metric in metrics if metric in functions):
+            calls += explanations
+
+        rows = self.get_shared_rows(metrics, approximate)
+        if rows is False or cached and rows is not None and len(np.setdiff1d(rows, self._predicted_rows)) == 0:
+            return calls
+        return calls + 1
+
+    def warm_metrics(self, metrics: list, approximate: float = None) -> None:
+        """
+        Computes the intermediates the given metrics share between all explanations in one batched pass, e.g. the
+        model predictions of the training set, before the first explanation. Override if your metrics share further
+        intermediates.
+
+        :param metrics: names of the metrics
+        :param approximate: half-width at which the metrics are approximated, None to compute them exactly
+        """
+        if type(self).predict_train is Explainer.predict_train:
+            return
+        rows = self.get_shared_rows(metrics, approximate)
+        if rows is not False:
+            self.get_train_predictions(rows)
 
     def infer_metrics(self, printing: bool = True) -> None:
         """
@@ -72,32 +291,182 @@ class Explainer:
         """
         xb.transfer.use_transfer(self)
         if printing:
-            print('inferred metrics:',
-                  {x for x in dir(self) if getattr(getattr(self, x), 'tag', None) in ['metric', 'utility']})
+            print('inferred metrics:', set(self.tagged('metric', 'utility')))
+
+    def get_strata(self) -> np.ndarray:
+        """
+        Returns the stratum of every training instance for the stratified subsamples of approximate metrics,
+        e.g. its target label. Override together with restrict_metrics and get_neighborhood_sample to support
+        approximate metrics.
+
+        :return: numpy array with one stratum per training instance
+        """
+        raise NotImplementedError
+
+    @contextlib.contextmanager
+    def restrict_metrics(self, rows: np.ndarray, weights: np.ndarray):
+        """
+        Context in which the metrics are evaluated on a weighted subsample of the training set instead of the whole
+        training set. Sums over the training set become weighted sums over the subsample.
+        Override together with get_strata to support approximate metrics.
+
+        :param rows: sorted indices of the sampled training instances
+        :param weights: weight of every sampled instance, the inverse of its inclusion probability
+        """
+        raise NotImplementedError
+        yield
+
+    def sample_training_set(self, fraction: float, rows: np.ndarray = None) -> tuple:
+        """
+        Returns the stratified subsample of the given fraction of the training set. The strata are ordered randomly
+        once, so that the subsamples are nested (see xb.utils.stratified_ranks) and the predictions of their rows
+        are reused when they grow.
+
+        :param fraction: sampled fraction of every stratum
+        :param rows: sorted training rows the subsample is restricted to, None for the whole training set
+        :return: tuple of the sample and its replicate groups as returned by xb.utils.stratified_sample
+        """
+        if '_sample_ranks' not in self.__dict__:
+            self._sample_ranks = xb.utils.stratified_ranks(self.get_strata(), random_state=0)
+        return xb.utils.stratified_sample(*self._sample_ranks, fraction, rows)
+
+    def get_metric_sample(self, approximate: float) -> tuple:
+        """
+        Returns the stratified subsample of the training set the totals are approximated on. It is drawn once per
+        target half-width and reused for all explanations.
+
+        :param approximate: half-width of the 95% confidence interval of proportion metrics
+        :return: tuple of the sample and its replicate groups as returned by xb.utils.stratified_sample, None if
+            the sample would contain the whole training set
+        """
+        samples = self.__dict__.setdefault('_metric_samples', {})
+        if approximate not in samples:
+            population = len(self.get_strata())
+            size = xb.utils.sample_size(approximate, population)
+            samples[approximate] = self.sample_training_set(size / population) if size < population else None
+        return samples[approximate]
+
+    def sample_neighborhood(self, approximate: float, rows: np.ndarray = None, kernel=None) -> tuple:
+        """
+        Draws the stratified subsample of a neighborhood that weighted averages over the neighborhood are
+        approximated on. The nested subsamples of the training set restricted to the neighborhood grow until the
+        effective size of the sampled neighborhood weights reaches the sample size of the half-width, so that small
+        or concentrated neighborhoods are sampled densely enough.
+
+        :param approximate: half-width of the 95% confidence interval of proportion metrics
+        :param rows: sorted training rows of the neighborhood, None for the whole training set
+        :param kernel: function returning the neighborhood weights of an index array of training rows, None if all
+            rows of the neighborhood weigh the same
+        :return: tuple of the sample and its replicate groups as returned by xb.utils.stratified_sample, None if
+            the sample would contain the whole neighborhood
+        """
+        population = len(self.get_strata()) if rows is None else len(rows)
+        fraction = xb.utils.sample_size(approximate, population) / max(population, 1)
+        while fraction < 1:
+            sample = self.sample_training_set(fraction, rows)
+            sampled, weights = sample[0]
+            if kernel is not None:
+                weights = weights * kernel(sampled)
+            # Kish's effective size of the weighted sample, a fraction of that of the whole neighborhood
+            effective = weights.sum() ** 2 / (weights ** 2).sum() if weights.any() else 0.
+            required = xb.utils.sample_size(approximate, effective / fraction)
+            if effective > 0 and effective >= required:
+                return sample
+            fraction = fraction * 2 if effective == 0 else fraction * max(1.1, required / effective)
+        return None
 
-    def report(self, tag=None, inferred_metrics=True) -> dict:
+    def get_neighborhood_sample(self, approximate: float) -> tuple:
+        """
+        Returns the stratified subsample of the neighborhood of the current explanation that the ratio metrics are
+        approximated on, e.g. drawn by sample_neighborhood. Override together with get_strata and restrict_metrics
+        to support approximate ratio metrics.
+
+        :param approximate: half-width of the 95% confidence interval of proportion metrics
+        :return: tuple of the sample and its replicate groups as returned by xb.utils.stratified_sample, None to
+            compute the ratio metrics exactly
+        """
+        raise NotImplementedError
+
+    def estimate_metrics(self, metrics: dict, approximate: float) -> dict:
+        """
+        Approximates the metrics that sum over the training set on stratified subsamples and computes all other
+        metrics exactly. Totals are approximated on a subsample of the training set that all explanations share,
+        ratios on a subsample of the neighborhood of the current explanation (see astrapia.decorators.ESTIMATORS).
+        The standard error of every estimate is derived from the spread of its values on the replicate groups of
+        the subsample. Metrics whose subsample would contain the whole population or whose spread cannot be
+        estimated are computed exactly, with a standard error of 0.
+
+        :param metrics: dictionary with key: name of the metric, value: metric function
+        :param approximate: half-width of the 95% confidence interval of proportion metrics
+        :return: dictionary with the value of every metric and the standard error of every approximated metric as
+            '<metric>_stderr'
+        """
+        estimates = {metric: f() for metric, f in metrics.items() if f.estimator is None}
+        for estimator in xb.ESTIMATORS:
+            group = {metric: f for metric, f in metrics.items() if f.estimator == estimator}
+            if not group:
+                continue
+            sample = self.get_metric_sample(approximate) if estimator == 'total' else \
+                self.get_neighborhood_sample(approximate)
+
+            exact = group
+            if sample is not None:
+                (rows, weights), replicates = sample
+                with self.restrict_metrics(rows, weights):
+                    estimates.update({metric: f() for metric, f in group.items()})
+
+                values = {metric: [] for metric in group}
+                for replicate in replicates:
+                    with self.restrict_metrics(*replicate):
+                        for metric, f in group.items():
+                            values[metric].append(f())
+
+                for metric in group:
+                    replicate_values = np.asarray(values[metric], dtype=float)
+                    replicate_values = replicate_values[~np.isnan(replicate_values)]
+                    estimates[metric + '_stderr'] = float(np.std(replicate_values, ddof=1) /
+                                                          np.sqrt(len(replicate_values))) \
+                        if len(replicate_values) > 1 else float('nan')
+                exact = {metric: f for metric, f in group.items()
+                         if np.isnan(estimates[metric + '_stderr']) and not np.isnan(estimates[metric])}
+
+            for metric, f in exact.items():
+                estimates[metric], estimates[metric + '_stderr'] = f(), 0.
+        return estimates
+
+    def report(self, tag=None, inferred_metrics=True, approximate=None, metrics=None) -> dict:
         """
         Compute metrics and properties for this explainer.
         If a tag is supplied, only the respective type of attribute is returned (metrics or properties)
 
-        :param inferred_metrics:
+        :param inferred_metrics: whether to include the metrics inferred by transfer functions, which are resolved
+            without adding them to the explainer
         :param tag: *None* or 'prop' or 'metric'
+        :param approximate: half-width of the 95% confidence interval, e.g. 0.005 for +-0.5%, at which the metrics
+            that sum over the training set are approximated on stratified subsamples and reported together with
+            their standard error as '<metric>_stderr' (see estimate_metrics), None to compute them exactly
+        :param metrics: names of the metrics to compute, None for all metrics. Properties are not affected.
         :return: a dictionary of metrics
         """
-        if inferred_metrics:
-            self.infer_metrics()
-
         if tag is None:
-            all_mu_identifier_references = {(x, getattr(self, x)) for x in dir(self) if
-                                            getattr(getattr(self, x), 'tag', None) in ['metric', 'prop']}
-        elif tag == 'metric':
-            all_mu_identifier_references = {(x, getattr(self, x)) for x in dir(self) if
-                                            getattr(getattr(self, x), 'tag', None) == 'metric'}
-        elif tag == 'prop':
-            all_mu_identifier_references = {(x, getattr(self, x)) for x in dir(self) if
-                                            getattr(getattr(self, x), 'tag', None) == 'prop'}
+            all_mu_identifier_references = {x: getattr(self, x) for x in self.tagged('metric', 'prop')}
+        elif tag in ['metric', 'prop']:
+            all_mu_identifier_references = {x: getattr(self, x) for x in self.tagged(tag)}
         else:
             raise ValueError(f'Tag should be either "metric" or "prop", not ${tag}')
 
-        implemented_mu_values = {(x, f()) for (x, f) in all_mu_identifier_references}
+        if inferred_metrics and tag != 'prop':
+            all_mu_identifier_references.update(xb.transfer.resolve_transfers(self))
+
+        if metrics is not None:
+            metrics = set(metrics)
+            all_mu_identifier_references = {x: f for (x, f) in all_mu_identifier_references.items()
+                                            if f.tag != 'metric' or x in metrics}
+
+        if approximate is not None:
+            metrics = {x: f for (x, f) in sorted(all_mu_identifier_references.items()) if f.tag == 'metric'}
+            props = {(x, f()) for (x, f) in all_mu_identifier_references.items() if f.tag == 'prop'}
+            return props | set(self.estimate_metrics(metrics, approximate).items())
+
+        implemented_mu_values = {(x, f()) for (x, f) in all_mu_identifier_references.items()}
         return implemented_mu_values
@@ -26,7 +26,9 @@
 
 from abc import ABCMeta, abstractmethod
 
+import joblib
 import numpy as np
+import scipy.stats
 import sklearn
 import sklearn.tree
 from sklearn.utils import check_random_state
@@ -74,38 +76,70 @@ class BaseDiscretizer():
             self.mins[feature] = [boundaries[0]] + qts.tolist()
             self.maxs[feature] = qts.tolist() + [boundaries[1]]
 
+        self.stack_bins()
+
     @abstractmethod
     def bins(self, data, labels):
         raise NotImplementedError("Must override bins() method")
 
+    def stack_bins(self):
+        """Stores the bin edges and bin statistics of all discretized features
+        as arrays with one row per feature, padded to the largest number of
+        bins, so that all features are discretized and undiscretized at once.
+        """
+        n_features = len(self.to_discretize)
+        n_bins = max([len(self.means[feature]) for feature in self.to_discretize], default=1)
+        self.feature_indices = np.array(self.to_discretize, dtype=int)
+        self.bin_edges = np.full((n_features, n_bins - 1), np.inf)
+        self.bin_means = np.zeros((n_features, n_bins))
+        self.bin_stds = np.ones((n_features, n_bins))
+        self.bin_mins = np.zeros((n_features, n_bins))
+        self.bin_maxs = np.zeros((n_features, n_bins))
+        for idx, feature in enumerate(self.to_discretize):
+            size = len(self.means[feature])
+            self.bin_edges[idx, :size - 1] = self.maxs[feature][:-1]
+            self.bin_means[idx, :size] = self.means[feature]
+            self.bin_stds[idx, :size] = self.stds[feature]
+            self.bin_mins[idx, :size] = self.mins[feature]
+            self.bin_maxs[idx, :size] = self.maxs[feature]
+
+    def bin_indices(self, values):
+        """Returns the bins of a matrix with one column per discretized
+        feature, i.e. the number of bin edges below each value, comparing all
+        features with their k-th edge at once.
+        """
+        indices = np.zeros(values.shape, dtype=int)
+        for edges in self.bin_edges.T:
+            indices += values > edges
+        return indices
+
     def discretize(self, data):
         ret = data.copy()
-        for feature in self.lambdas:
-            if len(data.shape) == 1:
-                ret[feature] = int(self.lambdas[feature](ret[feature]))
-            else:
-                ret[:, feature] = self.lambdas[feature](
-                    ret[:, feature]).astype(int)
+        rows = ret.reshape(1, -1) if len(data.shape) == 1 else ret
+        rows[:, self.feature_indices] = self.bin_indices(rows[:, self.feature_indices])
         return ret
 
-    def undiscretize(self, data):
+    def undiscretize(self, data, uniform=None):
+        """Samples values of the bins in data from a normal distribution
+        around the bin mean, clipped to the bounds of the bin. If uniform
+        samples of shape (rows, discretized features) are given, the normal
+        values are obtained from them through the inverse normal CDF.
+        """
         ret = data.copy()
-        for feature in self.means:
-            mins = self.mins[feature]
-            maxs = self.maxs[feature]
-            means = self.means[feature]
-            stds = self.stds[feature]
-
-            def get_inverse(q):
-                return max(mins[q],
-                           min(self.random_state.normal(means[q], stds[q]), maxs[q]))
-
-            if len(data.shape) == 1:
-                q = int(ret[feature])
-                ret[feature] = get_inverse(q)
-            else:
-                ret[:, feature] = (
-                    [get_inverse(int(x)) for x in ret[:, feature]])
+        rows = ret.reshape(1, -1) if len(data.shape) == 1 else ret
+        # one normal draw per cell in feature-major order, as the former
+        # per-cell draws, clipped to the bounds of the bin
+        bins = rows[:, self.feature_indices].astype(int).T
+        features = np.arange(len(self.feature_indices))[:, np.newaxis]
+        if uniform is None:
+            samples = self.random_state.normal(self.bin_means[features, bins],
+                                               self.bin_stds[features, bins])
+        else:
+            samples = self.bin_means[features, bins] + self.bin_stds[features, bins] * \
+                scipy.stats.norm.ppf(np.asarray(uniform).reshape(rows.shape[0], -1).T)
+        samples = np.maximum(self.bin_mins[features, bins],
+                             np.minimum(samples, self.bin_maxs[features, bins]))
+        rows[:, self.feature_indices] = samples.T
         return ret
 
 
@@ -139,7 +173,8 @@ class DecileDiscretizer(BaseDiscretizer):
 
 
 class EntropyDiscretizer(BaseDiscretizer):
-    def __init__(self, data, categorical_features, feature_names, labels=None, random_state=None):
+    def __init__(self, data, categorical_features, feature_names, labels=None, random_state=None, n_jobs=-1):
+        self.n_jobs = n_jobs
         if (labels is None):
             raise ValueError('Labels must be not None when using \
                              EntropyDiscretizer')
@@ -148,20 +183,26 @@ class EntropyDiscretizer(BaseDiscretizer):
                                  random_state=random_state)
 
     def bins(self, data, labels):
-        bins = []
-        for feature in self.to_discretize:
-            dt = sklearn.tree.DecisionTreeClassifier(criterion='entropy',
-                                                     max_depth=3,
-                                                     random_state=self.random_state)
-            x = np.reshape(data[:, feature], (-1, 1))
-            dt.fit(x, labels)
-            qts = dt.tree_.threshold[np.where(dt.tree_.children_left > -1)]
-
-            if qts.shape[0] == 0:
-                qts = np.array([np.median(data[:, feature])])
-            else:
-                qts = np.sort(qts)
-
-            bins.append(qts)
-
-        return bins
+        # the trees are fitted in parallel threads, each with its own seed,
+        # drawn from the random state like the sequential fits drew them
+        seeds = self.random_state.randint(0, np.iinfo(np.int32).max,
+                                          size=len(self.to_discretize))
+        return joblib.Parallel(n_jobs=self.n_jobs, prefer='threads')(
+            joblib.delayed(self.feature_bins)(data[:, feature], labels, seed)
+            for feature, seed in zip(self.to_discretize, seeds))
+
+    @staticmethod
+    def feature_bins(column, labels, seed):
+        dt = sklearn.tree.DecisionTreeClassifier(criterion='entropy',
+                                                 max_depth=3,
+                                                 random_state=seed)
+        x = np.reshape(column, (-1, 1))
+        dt.fit(x, labels)
+        qts = dt.tree_.threshold[np.where(dt.tree_.children_left > -1)]
+
+        if qts.shape[0] == 0:
+            qts = np.array([np.median(column)])
+        else:
+            qts = np.sort(qts)
+
+        return qts
@@ -28,6 +28,7 @@ import numpy as np
 from boruta import BorutaPy
 from sklearn.ensemble import RandomForestRegressor
 from sklearn.linear_model import Ridge, lars_path
+from sklearn.metrics import r2_score
 from sklearn.utils import check_random_state
 
 
@@ -50,25 +51,85 @@ class LimeBase(object):
         return alphas, coefs
 
     def forward_selection(self, data, labels, weights, num_features):
-        clf = Ridge(alpha=0, fit_intercept=True, random_state=self.random_state)
+        return self.forward_selection_labels(data, labels[:, np.newaxis],
+                                             weights, num_features)[0]
+
+    def forward_selection_labels(self, data, labels, weights, num_features):
+        """Greedily selects the features that maximize the weighted R^2 of a
+        linear model with intercept and without regularization.
+
+        Instead of refitting a model per candidate, the weighted Gram matrix of
+        the centered data is computed once. The selected features are
+        orthonormalized incrementally (a Cholesky factor that grows by one row
+        per step), so the gain in explained variance of every candidate
+        follows from its projection onto the selected features. Candidates
+        that are linear combinations of the selected features gain nothing,
+        as refitting the model with them does not change its score.
+
+        The Gram matrix is shared by all columns of labels, one selection is
+        returned per column.
+        """
+        weights = np.asarray(weights, dtype=float)
+        total_weight = weights.sum()
+        centered = data - weights @ data / total_weight
+        centered_labels = labels - weights @ labels / total_weight
+        weighted = centered * weights[:, np.newaxis]
+        gram = weighted.T @ centered
+        covariances = weighted.T @ centered_labels
+        variance = np.diag(gram).copy()
+        return [self.select_forward(gram, variance, covariances[:, column], num_features)
+                for column in range(labels.shape[1])]
+
+    @staticmethod
+    def select_forward(gram, variance, covariance, num_features):
+        n_features = gram.shape[0]
+        # row i holds the coordinates of all features on the i-th orthonormal direction
+        projections = np.zeros((0, n_features))
+        explained = np.zeros(0)
+        available = np.ones(n_features, dtype=bool)
         used_features = []
-        for _ in range(min(num_features, data.shape[1])):
-            max_ = -100000000
-            best = 0
-            for feature in range(data.shape[1]):
-                if feature in used_features:
-                    continue
-                clf.fit(data[:, used_features + [feature]], labels,
-                        sample_weight=weights)
-                score = clf.score(data[:, used_features + [feature]],
-                                  labels,
-                                  sample_weight=weights)
-                if score > max_:
-                    best = feature
-                    max_ = score
+        for _ in range(min(num_features, n_features)):
+            residual = variance - np.einsum('ij,ij->j', projections, projections)
+            residual_covariance = covariance - explained @ projections
+            independent = available & (residual > 1e-10 * variance)
+            gains = np.zeros(n_features)
+            gains[independent] = residual_covariance[independent] ** 2 / residual[independent]
+            gains[~available] = -np.inf
+
+            # candidates whose gains only differ by rounding errors are ties, the first one is selected
+            best = int(np.argmax(gains >= gains.max() - 1e-9 * abs(gains.max())))
             used_features.append(best)
+            available[best] = False
+            if independent[best]:
+                norm = np.sqrt(residual[best])
+                direction = (gram[best] - projections[:, best] @ projections) / norm
+                projections = np.vstack([projections, direction])
+                explained = np.append(explained, residual_covariance[best] / norm)
         return np.array(used_features)
 
+    def feature_selection_labels(self, data, labels, weights, num_features, method):
+        """Selects the features of every column of labels. Forward selection
+        shares its Gram matrix between the columns and highest weights fits one
+        multi-output model, the other methods select the features of each
+        column separately."""
+        if method == 'auto':
+            method = 'forward_selection' if num_features <= 6 else 'highest_weights'
+        if method == 'forward_selection':
+            return self.forward_selection_labels(data, labels, weights, num_features)
+        if method == 'highest_weights':
+            clf = Ridge(alpha=0, fit_intercept=True,
+                        random_state=self.random_state)
+            clf.fit(data, labels, sample_weight=weights)
+            selections = []
+            for coef in np.reshape(clf.coef_, (labels.shape[1], -1)):
+                feature_weights = sorted(zip(range(data.shape[0]), coef * data[0]),
+                                         key=lambda x: np.abs(x[1]),
+                                         reverse=True)
+                selections.append(np.array([x[0] for x in feature_weights[:num_features]]))
+            return selections
+        return [self.feature_selection(data, labels[:, column], weights, num_features, method)
+                for column in range(labels.shape[1])]
+
     def feature_selection(self, data, labels, weights, num_features, method):
         if method == 'none':
             return np.array(range(data.shape[1]))
@@ -119,32 +180,73 @@ class LimeBase(object):
                                    feature_selection='auto',
                                    model_regressor=None,
                                    regressor='linear'):
+        return self.explain_labels_with_data(neighborhood_data,
+                                             neighborhood_labels,
+                                             distances,
+                                             [label],
+                                             num_features,
+                                             feature_selection=feature_selection,
+                                             model_regressor=model_regressor,
+                                             regressor=regressor)[label]
+
+    def explain_labels_with_data(self,
+                                 neighborhood_data,
+                                 neighborhood_labels,
+                                 distances,
+                                 labels,
+                                 num_features,
+                                 feature_selection='auto',
+                                 model_regressor=None,
+                                 regressor='linear'):
+        """Fits the surrogate models of several labels on one neighborhood.
+
+        The kernel weights are computed once. Labels for which the same
+        features are selected share one multi-output fit of the regressor.
+
+        Returns a dictionary mapping every label to the tuple of intercept,
+        sorted feature weights, score and local prediction that
+        explain_instance_with_data returns for it.
+        """
         weights = self.kernel_fn(distances)
-        labels_column = neighborhood_labels[:, label]
-        used_features = self.feature_selection(neighborhood_data,
-                                               labels_column,
-                                               weights,
-                                               num_features,
-                                               feature_selection)
+        labels = list(labels)
+        labels_columns = neighborhood_labels[:, labels]
+        selections = self.feature_selection_labels(neighborhood_data,
+                                                   labels_columns,
+                                                   weights,
+                                                   num_features,
+                                                   feature_selection)
 
         if model_regressor is None:
             model_regressor = Ridge(alpha=1, fit_intercept=True,
                                     random_state=self.random_state)
-        easy_model = model_regressor
-        easy_model.fit(neighborhood_data[:, used_features],
-                       labels_column, sample_weight=weights)
-        prediction_score = easy_model.score(
-            neighborhood_data[:, used_features],
-            labels_column, sample_weight=weights)
-
-        local_pred = easy_model.predict(neighborhood_data[0, used_features].reshape(1, -1))
-
-        if self.verbose:
-            print('Intercept', easy_model.intercept_)
-            print('Prediction_local', local_pred, )
-            print('Right:', neighborhood_labels[0, label])
-
-        return (easy_model.intercept_,
-                sorted(zip(used_features, easy_model.coef_),
-                       key=lambda x: np.abs(x[1]), reverse=True),
-                prediction_score, local_pred)
+
+        groups = {}
+        for position, used_features in enumerate(selections):
+            groups.setdefault(tuple(used_features), []).append(position)
+
+        results = {}
+        for used_features, positions in groups.items():
+            used_features = np.array(used_features, dtype=int)
+            easy_model = model_regressor
+            easy_model.fit(neighborhood_data[:, used_features],
+                           labels_columns[:, positions], sample_weight=weights)
+            prediction_scores = r2_score(
+                labels_columns[:, positions],
+                easy_model.predict(neighborhood_data[:, used_features]),
+                sample_weight=weights, multioutput='raw_values')
+            local_preds = easy_model.predict(neighborhood_data[0, used_features].reshape(1, -1))
+
+            intercepts = np.reshape(easy_model.intercept_, -1)
+            coefficients = np.reshape(easy_model.coef_, (len(positions), -1))
+            for idx, position in enumerate(positions):
+                label = labels[position]
+                if self.verbose:
+                    print('Intercept', intercepts[idx])
+                    print('Prediction_local', local_preds[:, idx], )
+                    print('Right:', neighborhood_labels[0, label])
+
+                results[label] = (intercepts[idx],
+                                  sorted(zip(used_features, coefficients[idx]),
+                                         key=lambda x: np.abs(x[1]), reverse=True),
+                                  prediction_scores[idx], local_preds[:, idx])
+        return results
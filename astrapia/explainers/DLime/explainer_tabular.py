@@ -31,11 +31,13 @@ import warnings
 from functools import partial
 
 import numpy as np
+import scipy.stats
 import sklearn
 import sklearn.preprocessing
 import sklearn.tree
 from sklearn.utils import check_random_state
 
+from astrapia.utils import quasi_random_uniform
 from astrapia.explainers.DLime import explainer_base
 from astrapia.explainers.DLime import explanation
 from astrapia.explainers.DLime.discretize import BaseDiscretizer
@@ -100,8 +102,11 @@ class LimeTabularExplainer(object):
                  discretize_continuous=False,
                  discretizer='quartile',
                  sample_around_instance=False,
-                 random_state=None):
+                 random_state=None,
+                 sampler='random',
+                 n_jobs=-1):
         self.random_state = check_random_state(random_state)
+        self.sampler = sampler
         self.mode = mode
         self.categorical_names = categorical_names or {}
         self.sample_around_instance = sample_around_instance
@@ -127,7 +132,8 @@ class LimeTabularExplainer(object):
             elif discretizer == 'entropy':
                 self.discretizer = EntropyDiscretizer(
                     training_data, self.categorical_features,
-                    self.feature_names, labels=training_labels)
+                    self.feature_names, labels=training_labels,
+                    n_jobs=n_jobs)
             elif isinstance(discretizer, BaseDiscretizer):
                 self.discretizer = discretizer
             else:
@@ -176,6 +182,16 @@ class LimeTabularExplainer(object):
     def convert_and_round(values):
         return ['%.2f' % v for v in values]
 
+    def sample_neighborhood(self, data_row, num_samples=5000):
+        """Samples the perturbations explain_instance_hclust fits the surrogate
+        model on if explainer='lime'.
+
+        Returns:
+            tuple of the neighborhood in the interpretable representation and
+            in the original representation, the first row is data_row
+        """
+        return self.__data_inverse(data_row, num_samples)
+
     def explain_instance_hclust(self,
                                 data_row,
                                 predict_fn,
@@ -186,10 +202,16 @@ class LimeTabularExplainer(object):
                                 distance_metric='euclidean',
                                 model_regressor=None,
                                 clustered_data=None,
-                                regressor='linear', explainer='lime'):
+                                regressor='linear', explainer='lime',
+                                clustered_labels=None,
+                                neighborhood=None):
 
         if explainer == 'lime':
-            data, inverse = self.__data_inverse(data_row, num_samples)
+            if neighborhood is None:
+                data, inverse = self.__data_inverse(data_row, num_samples)
+            else:
+                # a neighborhood returned by sample_neighborhood, used as is
+                data, inverse = neighborhood
             scaled_data = (data - self.scaler.mean_) / self.scaler.scale_
 
             distances = sklearn.metrics.pairwise_distances(
@@ -198,7 +220,8 @@ class LimeTabularExplainer(object):
                 metric=distance_metric
             ).ravel()
 
-            yss = predict_fn(inverse)
+            # the model predictions of a given neighborhood can be passed in
+            yss = predict_fn(inverse) if clustered_labels is None else np.asarray(clustered_labels)
         else:
             data, inverse = self.__data_inverse_hclust(data_row, clustered_data)
             scaled_data = (data - self.scaler.mean_) / self.scaler.scale_
@@ -209,7 +232,8 @@ class LimeTabularExplainer(object):
                 metric=distance_metric
             ).ravel()
 
-            yss = predict_fn(clustered_data)
+            # the model predictions of the cluster can be passed in, the first row is the explained instance
+            yss = predict_fn(inverse) if clustered_labels is None else np.asarray(clustered_labels)
 
         if self.mode == "classification":
             if len(yss.shape) == 1:
@@ -293,17 +317,18 @@ class LimeTabularExplainer(object):
             ret_exp.max_value = max_y
             labels = [0]
 
+        surrogates = self.base.explain_labels_with_data(
+            scaled_data,
+            yss,
+            distances,
+            labels,
+            num_features,
+            model_regressor=model_regressor,
+            feature_selection=self.feature_selection, regressor=regressor)
         for label in labels:
             (ret_exp.intercept[label],
              ret_exp.local_exp[label],
-             ret_exp.score[label], ret_exp.local_pred[label]) = self.base.explain_instance_with_data(
-                scaled_data,
-                yss,
-                distances,
-                label,
-                num_features,
-                model_regressor=model_regressor,
-                feature_selection=self.feature_selection, regressor=regressor)
+             ret_exp.score[label], ret_exp.local_pred[label]) = surrogates[label]
 
         if self.mode == "regression":
             ret_exp.intercept[1] = ret_exp.intercept[0]
@@ -315,12 +340,25 @@ class LimeTabularExplainer(object):
     def __data_inverse(self,
                        data_row,
                        num_samples):
-        data = np.zeros((num_samples, data_row.shape[0]))
-        categorical_features = range(data_row.shape[0])
+        num_cols = data_row.shape[0]
+        data = np.zeros((num_samples, num_cols))
+        categorical_features = range(num_cols)
+        uniform = None
+        if self.sampler != 'random':
+            # the first columns of the low-discrepancy points drive the
+            # continuous values, the remaining ones the categorical values
+            num_categorical = num_cols if self.discretizer is not None \
+                else len(self.categorical_features)
+            uniform = quasi_random_uniform(self.sampler, num_samples,
+                                           num_cols + num_categorical,
+                                           self.random_state)
         if self.discretizer is None:
-            data = self.random_state.normal(
-                0, 1, num_samples * data_row.shape[0]).reshape(
-                num_samples, data_row.shape[0])
+            if uniform is None:
+                data = self.random_state.normal(
+                    0, 1, num_samples * num_cols).reshape(
+                    num_samples, num_cols)
+            else:
+                data = scipy.stats.norm.ppf(uniform[:, :num_cols])
             if self.sample_around_instance:
                 data = data * self.scaler.scale_ + data_row
             else:
@@ -331,47 +369,67 @@ class LimeTabularExplainer(object):
             first_row = self.discretizer.discretize(data_row)
         data[0] = data_row.copy()
         inverse = data.copy()
-        for column in categorical_features:
-            values = self.feature_values[column]
-            freqs = self.feature_frequencies[column]
-            inverse_column = self.random_state.choice(values, size=num_samples,
-                                                      replace=True, p=freqs)
-            binary_column = np.array([1 if x == first_row[column]
-                                      else 0 for x in inverse_column])
-            binary_column[0] = 1
-            inverse_column[0] = data[0, column]
-            data[:, column] = binary_column
-            inverse[:, column] = inverse_column
+        categorical_features = list(categorical_features)
+        if categorical_features:
+            inverse_columns = self.__sample_categorical(
+                categorical_features, num_samples,
+                None if uniform is None else uniform[:, num_cols:].T)
+            binary_columns = (inverse_columns == first_row[categorical_features]).astype(int)
+            binary_columns[0] = 1
+            inverse_columns[0] = data[0, categorical_features]
+            data[:, categorical_features] = binary_columns
+            inverse[:, categorical_features] = inverse_columns
         if self.discretizer is not None:
-            inverse[1:] = self.discretizer.undiscretize(inverse[1:])
+            inverse[1:] = self.discretizer.undiscretize(
+                inverse[1:], None if uniform is None else
+                uniform[1:, self.discretizer.feature_indices])
         inverse[0] = data_row
         return data, inverse
 
+    def __sample_categorical(self, categorical_features, num_samples,
+                             uniform=None):
+        """Draws all categorical columns from their training distributions at once.
+
+        Consumes the random state exactly like one random_state.choice call per
+        column in the given order: the uniform samples of all columns are drawn
+        in one block and mapped through the cumulative distributions of the
+        columns, which are stacked with an offset of one per column, so that a
+        single searchsorted finds the sampled value of every column. Uniform
+        samples of shape (columns, num_samples) can be passed in instead, e.g.
+        low-discrepancy points.
+        """
+        cdfs = []
+        values = []
+        for idx, column in enumerate(categorical_features):
+            cdf = np.cumsum(self.feature_frequencies[column])
+            cdfs.append(cdf / cdf[-1] + idx)
+            values.append(self.feature_values[column])
+        if uniform is None:
+            uniform = self.random_state.random_sample((len(categorical_features), num_samples))
+        offsets = np.arange(len(categorical_features))[:, np.newaxis]
+        # uniform samples close to 1 can round up to the offset of the next column, which would select a value of
+        # the next column (or past the end for the last column)
+        shifted = np.minimum(uniform + offsets, np.nextafter(offsets + 1., 0))
+        indices = np.concatenate(cdfs).searchsorted(shifted, side='right')
+        return np.concatenate(values)[indices].T.astype(float)
+
     def __data_inverse_hclust(self,
                               data_row,
                               samples):
-        data = np.zeros((samples.shape[0], data_row.shape[0]))
-        categorical_features = range(data_row.shape[0])
-
-        first_row = self.discretizer.discretize(data_row)
-        data[0] = data_row.copy()
-        inverse = data.copy()
-        for column in categorical_features:
-            values = self.feature_values[column]
-            freqs = self.feature_frequencies[column]
-
-            inverse_column = samples[:, column]
-            # self.random_state.choice(values, size=num_samples,
-            #                                       replace=True, p=freqs)
-            binary_column = np.array([1 if x == data_row[column]
-                                      else 0 for x in inverse_column])
-            binary_column[0] = 1
-            inverse_column[0] = data[0, column]
-            data[:, column] = binary_column
-            inverse[:, column] = inverse_column
-        # if self.discretizer is not None:
-        #     inverse[1:] = self.discretizer.undiscretize(inverse[1:])
+        # the first sample is replaced by the explained instance, the samples of the caller are left unchanged
+        inverse = np.array(samples, dtype=float)
         inverse[0] = data_row
+        data = inverse.copy()
+
+        first_row = data_row
+        discretized = inverse
+        if self.discretizer is not None:
+            first_row = self.discretizer.discretize(data_row)
+            discretized = self.discretizer.discretize(inverse)
+
+        categorical_features = list(self.categorical_features)
+        data[:, categorical_features] = (discretized[:, categorical_features] ==
+                                         first_row[categorical_features]).astype(float)
         return data, inverse
 
 
@@ -381,7 +439,7 @@ class RecurrentTabularExplainer(LimeTabularExplainer):
                  categorical_features=None, categorical_names=None,
                  kernel_width=None, kernel=None, verbose=False, class_names=None,
                  feature_selection='auto', discretize_continuous=True,
-                 discretizer='quartile', random_state=None):
+                 discretizer='quartile', random_state=None, n_jobs=-1):
         n_samples, n_timesteps, n_features = training_data.shape
         training_data = np.transpose(training_data, axes=(0, 2, 1)).reshape(
             n_samples, n_timesteps * n_features)
@@ -404,7 +462,8 @@ class RecurrentTabularExplainer(LimeTabularExplainer):
             feature_selection=feature_selection,
             discretize_continuous=discretize_continuous,
             discretizer=discretizer,
-            random_state=random_state)
+            random_state=random_state,
+            n_jobs=n_jobs)
 
     def _make_predict_proba(self, func):
         def predict_proba(X):
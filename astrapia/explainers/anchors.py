@@ -1,3 +1,6 @@
+import contextlib
+import copy
+
 import numpy as np
 import pandas as pd
 from anchor import anchor_tabular
@@ -29,9 +32,15 @@ class AnchorsExplainer(Explainer):
             self.anchors_dataset['data'],
             self.anchors_dataset['categorical_names'])
         self.meta = data
+        self.predict = predict_fn
+
+        self.index = self.build_index(self.anchors_dataset['data'])
+        self.label_bitmap = self.index.pack(self.anchors_dataset['labels'] == 1)
+        self.feature_maxima = np.amax(self.anchors_dataset['data'], axis=0)
+        self.sample = None
 
         def transformed_predict(data):
-            return predict_fn(self.inverse_transform_dataset({'data': data}, self.meta))[:, 1] > 0.5
+            return self.predict(self.inverse_transform_dataset({'data': data}, self.meta))[:, 1] > 0.5
 
         self.predictor = transformed_predict
 
@@ -46,22 +55,13 @@ class AnchorsExplainer(Explainer):
             'categorical_names': {idx: [str(x) for x in meta.categorical_features[feature]] for idx, feature
                                   in enumerate(meta.feature_names) if feature in meta.categorical_features},
             'feature_names': meta.feature_names,
-            'data': data.to_numpy()
+            'data': xb.utils.ordinal_codec(meta).encode(data)
         }
 
-        for feature_idx in result['categorical_features']:
-            feature_map = {feature: idx for idx, feature in enumerate(result['categorical_names'][feature_idx])}
-            result['data'][:, feature_idx] = np.vectorize(lambda x: feature_map[str(x)])(result['data'][:, feature_idx])
-
         return result
 
     def inverse_transform_dataset(self, data: any, meta: xb.Dataset) -> pd.DataFrame:
-        df = pd.DataFrame(data['data'], columns=meta.feature_names)
-        for feature_idx in [i for i, label in (enumerate(meta.data.keys())) if
-                            label in meta.categorical_features.keys()]:
-            df[meta.feature_names[feature_idx]] = df[meta.feature_names[feature_idx]].map(
-                lambda entry: meta.categorical_features[meta.feature_names[feature_idx]][entry])
-        return df
+        return xb.utils.ordinal_codec(meta).decode(data['data'])
 
     def explain_instance(self, instance):
         """
@@ -73,13 +73,42 @@ class AnchorsExplainer(Explainer):
         :return: the explanation
         """
 
-        instance = self.transform_dataset(instance, self.meta)
+        instance = xb.utils.ordinal_codec(self.meta).encode(instance)[0]
 
-        self.explanation = self.explainer.explain_instance(instance['data'][0], self.predictor,
-                                                           threshold=self.min_precision)
-        self.instance = instance['data'][0]
+        self.explanation = self.explainer.explain_instance(instance, self.predictor, threshold=self.min_precision)
+        self.instance = instance
         return self.explanation
 
+    def detach_explanation(self, explanation):
+        """
+        Drops the reference to the html renderer of the anchor explainer, which cannot be pickled
+
+        :param explanation: anchor explanation
+        :return: picklable copy of the explanation
+        """
+        explanation = copy.copy(explanation)
+        explanation.as_html_fn = None
+        return explanation
+
+    def attach_explanation(self, explanation):
+        """
+        Restores the html renderer of an explanation that was detached
+
+        :param explanation: detached anchor explanation
+        :return: the explanation
+        """
+        explanation.as_html_fn = self.explainer.as_html
+        return explanation
+
+    def predict_train(self, rows=None):
+        """
+        Predicts the labels of the training set or some of its rows with the model
+
+        :param rows: sorted index array of training rows, None for all rows
+        :return: predicted labels of the rows as boolean numpy array
+        """
+        return self.predictor(self.anchors_dataset['data'] if rows is None else self.anchors_dataset['data'][rows])
+
     @xb.prop
     def shape(self):
         return 'Hyperrectangle'
@@ -108,12 +137,9 @@ class AnchorsExplainer(Explainer):
         Number of instances within the neighbourhood.
         """
         if hasattr(self, 'explanation'):
-            try:
-                return self.get_fit_anchor(self.anchors_dataset['data']).shape[0]
-            except AttributeError:
-                return 0
+            return self.index.count(self.get_anchor_bitmap())
 
-    @xb.metric
+    @xb.metric(cost='model', estimator='ratio')
     def accuracy(self):
         """
         Relative amount of data elements in explanation neighborhood or given dataset that have the same explanation
@@ -122,11 +148,10 @@ class AnchorsExplainer(Explainer):
         :return: the accuracy value
         """
         if hasattr(self, 'explanation'):
-            explanation_label = self.explanation.exp_map["prediction"]
-            neighborhood = self.anchors_dataset['data'][self.get_fit_anchor(self.anchors_dataset['data'])]
-            if len(neighborhood) > 0:
-                ml_pred = self.predictor(neighborhood)
-                return np.count_nonzero(ml_pred == explanation_label) / len(neighborhood)
+            size, positive = self.count_model_positives()
+            if size > 0:
+                agreeing = positive if self.explanation.exp_map["prediction"] else size - positive
+                return agreeing / size
             else:
                 return np.nan
 
@@ -153,7 +178,7 @@ class AnchorsExplainer(Explainer):
         if hasattr(self, 'explanation'):
             return int(self.explanation.exp_map["prediction"])
 
-    @xb.metric
+    @xb.metric(cost='model', estimator='ratio')
     def balance_model(self):
         """
         Relative amount of data elements in the neighborhood of the explanation that had a label value of 1 assigned
@@ -162,10 +187,9 @@ class AnchorsExplainer(Explainer):
         :return: the balance value
         """
         if hasattr(self, 'explanation'):
-            pred = self.predictor(self.anchors_dataset['data'])
-            neighborhood = pred[self.get_fit_anchor(self.anchors_dataset['data'])]
-            if neighborhood.size > 0:
-                return np.mean(neighborhood)
+            size, positive = self.count_model_positives()
+            if size > 0:
+                return positive / size
             else:
                 return np.nan
 
@@ -177,9 +201,10 @@ class AnchorsExplainer(Explainer):
         :return: the balance value
         """
         if hasattr(self, 'explanation'):
-            neighborhood = self.anchors_dataset['labels'][self.get_fit_anchor(self.anchors_dataset['data'])]
-            if neighborhood.size > 0:
-                return np.mean(neighborhood)
+            neighborhood = self.get_anchor_bitmap()
+            size = self.index.count(neighborhood)
+            if size > 0:
+                return self.index.count(neighborhood & self.label_bitmap) / size
             else:
                 return np.nan
 
@@ -192,10 +217,134 @@ class AnchorsExplainer(Explainer):
         :return: the area value
         """
         if hasattr(self, 'explanation'):
-            array = np.amax(self.anchors_dataset['data'], axis=0)[self.explanation.features()]
+            array = self.feature_maxima[self.explanation.features()]
             array = array + 1
             return np.prod(1 / array)
 
+    def build_index(self, dataset):
+        """
+        Builds the bitmap index of an ordinal encoded dataset, with value bitmaps for all features and bin bitmaps
+        for the ordinal features discretized by the anchor explainer
+
+        :param dataset: ordinal encoded dataset
+        :return: BitmapIndex of the dataset
+        """
+        discretized = self.explainer.d_train if dataset is self.explainer.train else \
+            self.explainer.disc.discretize(dataset)
+        return xb.BitmapIndex(dataset, discretized, self.explainer.ordinal_features)
+
+    @xb.per_explanation
+    def get_anchor_bitmap(self):
+        """
+        Returns the training instances in the neighborhood of the current explanation as bitmap of the index.
+        The bitmap is computed once per explanation and shared by all metrics.
+
+        :return: packed bitmap
+        """
+        return self.compile_anchor(self.index)
+
+    def compile_anchor(self, index):
+        """
+        Evaluates the predicates of the current explanation on a bitmap index. Data elements that share the values
+        of the explained instance on all anchor features form the neighborhood. If there are none, the neighborhood
+        is derived from the anchor itself: categorical features must equal the instance, ordinal features must lie
+        in the range of bins named by the explanation.
+
+        :param index: BitmapIndex of the dataset
+        :return: packed bitmap of the neighborhood
+        """
+        features = list(dict.fromkeys(self.explanation.features()))
+
+        exact = index.full
+        for feature in features:
+            exact = exact & index.equal(feature, self.instance[feature])
+        if index.count(exact) > 0:
+            return exact
+
+        # anchor_tabular names every ordinal feature once, in the order of its first occurrence
+        try:
+            neighborhood = index.full
+            for feature, name in zip(features, self.explanation.names()):
+                if feature in self.explainer.ordinal_features:
+                    neighborhood = neighborhood & index.bin_range(feature, *self.get_bin_range(feature, name))
+                else:
+                    neighborhood = neighborhood & index.equal(feature, self.instance[feature])
+            return neighborhood
+        except ValueError:
+            return exact
+
+    def count_model_positives(self):
+        """
+        Returns the number of training instances in the neighborhood of the current explanation and how many of them
+        the model assigns the label 1. Only the instances of the neighborhood are predicted, or, while the metrics
+        are restricted to a subsample of the neighborhood, the sampled instances, whose weights estimate both.
+
+        :return: tuple of the size of the neighborhood and the number of positive instances
+        """
+        if self.sample is None:
+            rows = self.index.rows(self.get_anchor_bitmap())
+            return len(rows), int(np.count_nonzero(self.get_train_predictions(rows)))
+        rows, weights = self.sample
+        return weights.sum(), (weights * self.get_train_predictions(rows)).sum()
+
+    def get_strata(self):
+        """
+        Returns the target label of every training instance, which stratifies the subsamples of approximate metrics
+
+        :return: numpy array of labels
+        """
+        return self.anchors_dataset['labels']
+
+    @contextlib.contextmanager
+    def restrict_metrics(self, rows, weights):
+        """
+        Context in which the metrics are evaluated on a weighted subsample of the neighborhood
+
+        :param rows: sorted indices of the sampled training instances
+        :param weights: weight of every sampled instance
+        """
+        state = self.sample
+        self.sample = rows, weights
+        try:
+            yield
+        finally:
+            self.sample = state
+
+    def get_neighborhood_sample(self, approximate):
+        """
+        Returns the subsample of the neighborhood the ratio metrics are approximated on, drawn from the training
+        instances the anchor applies to
+
+        :param approximate: half-width of the 95% confidence interval of proportion metrics
+        :return: the sample and its replicate groups, None to compute the ratio metrics exactly
+        """
+        return self.sample_neighborhood(approximate, self.index.rows(self.get_anchor_bitmap()))
+
+    def get_bin_range(self, feature, name):
+        """
+        Translates the name of an ordinal anchor predicate back into the bins of the discretizer
+
+        :param feature: index of the ordinal feature
+        :param name: name of the predicate, e.g. 'a <= 2.00', 'a > 2.00' or '1.00 < a <= 2.00'
+        :return: tuple of exclusive lower bin and inclusive upper bin, None if unbounded
+        """
+        feature_name = self.explainer.feature_names[feature]
+        # the bin names of the discretizer end with their upper edge
+        edges = [bin_name.split()[-1] for bin_name in self.explainer.categorical_names[feature][:-1]]
+
+        lower, upper = None, None
+        if name.startswith(feature_name + ' <= '):
+            upper = name[len(feature_name) + 4:]
+        elif name.startswith(feature_name + ' > '):
+            lower = name[len(feature_name) + 3:]
+        elif ' < %s <= ' % feature_name in name:
+            lower, upper = name.split(' < %s <= ' % feature_name)
+        else:
+            raise ValueError(f'Unknown predicate {name!r} of feature {feature_name!r}')
+
+        return (edges.index(lower) if lower is not None else None,
+                edges.index(upper) if upper is not None else None)
+
     @xb.utility
     def get_fit_anchor(self, dataset):
         """
@@ -204,38 +353,10 @@ class AnchorsExplainer(Explainer):
         :param dataset: provided dataset
         :return: indices as numpy array
         """
-        indices_categorical = np.where(np.all(dataset[:, self.explanation.features()] ==
-                                              self.instance[self.explanation.features()], axis=1))[0]
-
-        if np.size(indices_categorical) > 0:
-            return indices_categorical
-
-        # derive neighborhood from the name of the explanation
-        try:
-            index_lists = []
-            for feature, name in zip(self.explanation.features(), self.explanation.names()):
-                if ">=" in name:
-                    index_lists.append(np.where(dataset[:, feature] >= float(name[name.index('>= ') + 3:])))
-                elif "<=" in name:
-                    index_lists.append(np.where(dataset[:, feature] <= float(name[name.index('<= ') + 3:])))
-                elif ">" in name:
-                    index_lists.append(np.where(dataset[:, feature] > float(name[name.index('> ') + 2:])))
-                elif "<" in name:
-                    index_lists.append(np.where(dataset[:, feature] < float(name[name.index('< ') + 2:])))
-                elif "=" in name:
-                    index_lists.append(np.where(dataset[:, feature] == name[name.index('= ') + 2:]))
-
-            # intersect different sublits of indices
-            indices_numerical = index_lists[0]
-            for i in range(1, len(index_lists)):
-                indices_numerical = np.intersect1d(indices_numerical, index_lists[i])
-
-            if np.size(indices_numerical) < np.size(indices_categorical):
-                return indices_categorical
-            else:
-                return indices_numerical
-        except:
-            return indices_categorical
+        if dataset is self.anchors_dataset['data']:
+            return self.index.rows(self.get_anchor_bitmap())
+        index = self.build_index(dataset)
+        return index.rows(self.compile_anchor(index))
 
     @xb.utility
     def get_explained_instance(self):
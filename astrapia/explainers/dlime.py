@@ -1,6 +1,11 @@
+import contextlib
+import hashlib
+import os
+
+import joblib
 import numpy as np
 import pandas as pd
-from sklearn.cluster import AgglomerativeClustering
+from sklearn.cluster import AgglomerativeClustering, MiniBatchKMeans
 from sklearn.linear_model import LinearRegression
 from sklearn.neighbors import NearestNeighbors
 
@@ -14,14 +19,42 @@ class DLimeExplainer(Explainer):
     Implementation of the DLime Explainer onto the base Explainer class
     """
 
-    def __init__(self, data, predict_fn, discretize_continuous=True):
+    # training sets up to this size are clustered exactly when the clustering backend is 'auto'
+    max_agglomerative_rows = 20000
+
+    def __init__(self, data, predict_fn, discretize_continuous=True, chunk_size=None, clustering='auto',
+                 n_clusters=2, n_subclusters=256, cache_dir=None, random_state=0, neighborhood='hclust',
+                 tolerance=None, min_samples=500, top_k=5, sampler='random', kernel_cutoff=None):
         """
         Initializes a DLime explainer
 
         :param data: data that is supposed to be explained
         :param predict_fn: classification model that is supposed to be explained
         :param discretize_continuous: should continuous values be separated into discrete categories
-        """
+        :param chunk_size: number of training rows per vectorized distance computation, None for all rows at once
+        :param clustering: 'agglomerative' clusters the training set hierarchically, 'minibatch' merges the centers
+            of a mini-batch k-means hierarchically, which scales to large training sets, 'auto' picks
+            'agglomerative' for training sets of up to max_agglomerative_rows rows
+        :param n_clusters: number of clusters of the training set
+        :param n_subclusters: number of k-means centers that are merged by the 'minibatch' backend
+        :param cache_dir: directory in which the fitted clustering and nearest neighbor index are stored and
+            reloaded from on later runs, None to fit them on every initialization
+        :param random_state: seed of the 'minibatch' backend
+        :param neighborhood: 'hclust' fits the surrogate model on the training instances of the cluster of the
+            explained instance, 'lime' on random perturbations of the instance
+        :param tolerance: maximum change of the surrogate coefficients at which an adaptively grown 'lime'
+            neighborhood is considered converged, None to always sample num_samples perturbations
+        :param min_samples: size of the first batch of an adaptively grown neighborhood
+        :param top_k: number of highest ranked features whose ranking and coefficients have to be stable for an
+            adaptively grown neighborhood to be considered converged, None for all selected features
+        :param sampler: 'random' samples 'lime' neighborhoods from pseudo-random numbers, 'sobol' or 'halton' from a
+            scrambled low-discrepancy sequence, whose explanations fluctuate less for the same number of samples
+        :param kernel_cutoff: kernel weight below which training instances are left out of the neighborhood
+            metrics, so that they are computed from a radius query instead of the whole training set, None to
+            weight all training instances
+        """
+        if tolerance is not None and neighborhood != 'lime':
+            raise ValueError("Adaptive sampling requires the 'lime' neighborhood")
         self.categorical_features = data.categorical_features
         self.data_keys = data.data.keys()
         self.data = data
@@ -29,23 +62,45 @@ class DLimeExplainer(Explainer):
         self.train = self.transform_dataset(data.data, data)
         self.dev = self.transform_dataset(data.data_dev, data)
         self.test = self.transform_dataset(data.data_test, data)
+        self.train_matrix = self.train.to_numpy(dtype=float)
+        self.chunk_size = chunk_size
 
-        self.explainer = DLimeTabularExplainer(self.train,
+        self.explainer = DLimeTabularExplainer(self.train_matrix,
                                                mode="classification",
                                                feature_names=self.train.keys(),
                                                class_names=data.target_names,
                                                categorical_features=None,
-                                               discretize_continuous=discretize_continuous)
-
-        clustering = AgglomerativeClustering().fit(self.train)
-        self.clustered_data = np.column_stack([self.train, clustering.labels_])
-
-        nbrs = NearestNeighbors(n_neighbors=1, algorithm='ball_tree').fit(self.train)
-        distances, self.indices = nbrs.kneighbors(self.test)
-        self.clabel = clustering.labels_
+                                               discretize_continuous=discretize_continuous,
+                                               sampler=sampler)
+
+        self.cache_dir = cache_dir
+        self.cache_key = hashlib.sha1(np.ascontiguousarray(self.train_matrix).tobytes() +
+                                      repr((list(self.train.columns), clustering, n_clusters, n_subclusters,
+                                            random_state)).encode()).hexdigest()
+
+        self.clabel = self.load_or_fit('clustering', lambda: self.fit_clustering(clustering, n_clusters,
+                                                                                 n_subclusters, random_state))
+        self.clustered_data = np.column_stack([self.train, self.clabel])
+        self.cluster_members = {label: np.flatnonzero(self.clabel == label) for label in np.unique(self.clabel)}
+        self._nearest_neighbors = None
+        self.neighborhood = neighborhood
+        self.tolerance = tolerance
+        if tolerance is None:
+            # the neighborhood only varies in size if it is grown adaptively
+            self.samples_used = None
+        self.min_samples = min_samples
+        self.top_k = top_k
 
         self.predict = predict_fn
         self.kernel_width = np.sqrt(self.train.shape[1]) * .75
+        self.kernel_cutoff = kernel_cutoff
+        if kernel_cutoff is None:
+            # without a cut-off the neighborhood is the whole training set, nothing is truncated and the transfer
+            # functions over its arrays would only describe the training set
+            self.get_neighborhood_instance = self.get_neighborhood_distances = self.get_neighborhood_weights = None
+            self.truncation_error = None
+        self.sample = None
+        self.train_labels = data.target.to_numpy().reshape((-1,)) == data.target_names[1]
 
     def transform_dataset(self, data: pd.DataFrame, meta: xb.Dataset) -> any:
         """
@@ -57,47 +112,179 @@ class DLimeExplainer(Explainer):
         """
         return xb.utils.onehot_encode(data, meta)
 
-    def inverse_transform_dataset(self, data: pd.DataFrame, meta: xb.Dataset):
+    def inverse_transform_dataset(self, data, meta: xb.Dataset):
         """
         Inverse transform an explainer-specific dataset into the general Astrapia Dataset format
 
-        :param data: pandas dataframe holding data in the shape LIME needs it
+        :param data: pandas dataframe or numpy array holding data in the shape LIME needs it
         :param meta: Astrapia Dataset object holding meta information that does not depend on data instances
         :returns: pandas dataframe in Astrapia Dataset format
         """
-        df = pd.DataFrame(index=data.index)
-        for feature in meta.categorical_features:
-            max_indices = np.argmax(
-                data[[feature + '_' + str(l) for l in meta.categorical_features[feature]]].to_numpy(), axis=1)
-            df[feature] = pd.Series([meta.categorical_features[feature][f] for f in max_indices], index=data.index)
-
-        continuous = list(meta.feature_names - meta.categorical_features.keys())
-        df[continuous] = data[continuous]
-        return df[meta.data.keys()]
+        return xb.utils.onehot_decode(data, meta)
 
-    def explain_instance(self, instance, num_features=10):
+    def explain_instance(self, instance, num_features=10, num_samples=5000):
         """
-        Creates a dlime explanation based on a given instance
+        Creates a dlime explanation based on a given instance. The 'hclust' neighborhood takes the model
+        predictions of the cluster members from the cached predictions of the training set. The explained instance
+        is the first row of the neighborhood, it is only predicted by the model if it is not a training instance.
 
         :param instance: instance as dataframe
         :param num_features: amount of features in the dataset
+        :param num_samples: size of the 'lime' neighborhood, the maximum size if the neighborhood is grown adaptively
         :return: the explanation
         """
 
-        self.instance = self.transform_dataset(instance, self.data).iloc[0]
+        self.instance = self.data.onehot.encode_row(instance)
+        predict_fn = lambda x: self.predict(self.inverse_transform_dataset(x, self.data))
+
+        if self.neighborhood == 'hclust':
+            # the neighborhood is the cluster of the closest training instance, whose model predictions are cached
+            # once predicted, so the explanation only calls the model for instances outside of the training set
+            neighbor = self.get_nearest_neighbor(self.instance)
+            members = self.cluster_members[self.clabel[neighbor]]
+            train_predictions = np.asarray(self.get_train_predictions(members))
+            if np.array_equal(self.train_matrix[neighbor], self.instance):
+                instance_prediction = np.asarray(self.get_train_predictions(np.array([neighbor])))
+            else:
+                instance_prediction = np.asarray(predict_fn(self.instance.reshape(1, -1)))
+            self.explanation = self.explainer.explain_instance_hclust(
+                self.instance, predict_fn,
+                num_features=num_features,
+                model_regressor=LinearRegression(),
+                regressor='linear',
+                labels=(0, 1),
+                clustered_data=np.vstack([self.instance, self.train_matrix[members]]),
+                clustered_labels=np.vstack([instance_prediction, train_predictions]),
+                explainer='dlime')
+            self.samples = len(members) + 1
+        elif self.neighborhood == 'lime' and self.tolerance is not None:
+            # the grown neighborhood is passed in both representations, so it keeps the binary representation lime
+            # sampled it with
+            self.explanation, self.samples = xb.utils.explain_adaptively(
+                lambda size: self.explainer.sample_neighborhood(self.instance, size), predict_fn,
+                lambda data, inverse, yss: self.explainer.explain_instance_hclust(
+                    self.instance, predict_fn,
+                    num_features=num_features,
+                    model_regressor=LinearRegression(),
+                    regressor='linear',
+                    labels=(0, 1),
+                    clustered_labels=yss,
+                    neighborhood=(data, inverse)),
+                num_samples, self.min_samples, self.tolerance, top_k=self.top_k)
+        elif self.neighborhood == 'lime':
+            self.explanation = self.explainer.explain_instance_hclust(self.instance, predict_fn,
+                                                                     num_features=num_features,
+                                                                     num_samples=num_samples,
+                                                                     model_regressor=LinearRegression(),
+                                                                     regressor='linear',
+                                                                     labels=(0, 1))
+            self.samples = num_samples
+        else:
+            raise ValueError(f'Unknown neighborhood {self.neighborhood!r}')
+
+        return self.explanation
+
+    def fit_clustering(self, clustering, n_clusters, n_subclusters, random_state):
+        """
+        Clusters the training set
+
+        :param clustering: clustering backend, 'agglomerative', 'minibatch' or 'auto'
+        :param n_clusters: number of clusters
+        :param n_subclusters: number of k-means centers that are merged by the 'minibatch' backend
+        :param random_state: seed of the 'minibatch' backend
+        :return: numpy array with the cluster label of every training instance
+        """
+        if clustering == 'auto':
+            clustering = 'agglomerative' if len(self.train_matrix) <= self.max_agglomerative_rows else 'minibatch'
+
+        if clustering == 'agglomerative':
+            return AgglomerativeClustering(n_clusters=n_clusters).fit(self.train_matrix).labels_
+        if clustering == 'minibatch':
+            subclusters = MiniBatchKMeans(n_clusters=min(n_subclusters, len(self.train_matrix)), n_init=3,
+                                          random_state=random_state).fit(self.train_matrix)
+            merged = AgglomerativeClustering(n_clusters=n_clusters).fit(subclusters.cluster_centers_).labels_
+            return merged[subclusters.labels_]
+        raise ValueError(f'Unknown clustering backend {clustering!r}')
 
-        p_label = self.clabel[self.indices[0]]
+    def load_or_fit(self, name, fit):
+        """
+        Loads a fitted object of the training set from the cache directory, or fits and stores it if it is missing
 
-        self.explanation = self.explainer.explain_instance_hclust(self.instance,
-                                                                 lambda x: self.predict(self.inverse_transform_dataset(
-                                                                     pd.DataFrame(x, columns=self.train.keys()), self.data)),
-                                                                 num_features=num_features,
-                                                                 model_regressor=LinearRegression(),
-                                                                 regressor='linear',
-                                                                 labels=(0, 1))
-        self.weighted_instances = self.get_weighted_instances()
+        :param name: name of the object
+        :param fit: function fitting the object
+        :return: the fitted object
+        """
+        if self.cache_dir is None:
+            return fit()
 
-        return self.explanation
+        path = os.path.join(self.cache_dir, f'dlime-{name}-{self.cache_key}.joblib')
+        if os.path.exists(path):
+            return joblib.load(path)
+
+        fitted = fit()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        joblib.dump(fitted, path)
+        return fitted
+
+    def get_nearest_neighbors(self):
+        """
+        Returns the nearest neighbor index of the training set, which also answers the radius queries of a truncated
+        kernel. It is only built when it is first queried.
+
+        :return: fitted NearestNeighbors
+        """
+        if self._nearest_neighbors is None:
+            self._nearest_neighbors = self.load_or_fit(
+                'neighbors', lambda: NearestNeighbors(n_neighbors=1, algorithm='ball_tree').fit(self.train_matrix))
+        return self._nearest_neighbors
+
+    def warm_up(self, seed=None):
+        """
+        Builds the nearest neighbor index and, for cluster neighborhoods, predicts the training set
+
+        :param seed: unused, none of the intermediates is sampled at random
+        """
+        if self.neighborhood == 'hclust' or self.kernel_cutoff is not None:
+            self.get_nearest_neighbors()
+        if self.neighborhood == 'hclust':
+            self.get_train_predictions()
+
+    def explanation_model_calls(self, explanations=1):
+        """
+        Returns the number of calls of the prediction function the explanations need. Cluster neighborhoods predict
+        the training set once and at most every explained instance, as training instances are not predicted again.
+
+        :param explanations: number of explanations
+        :return: number of model calls
+        """
+        if self.neighborhood != 'hclust':
+            return explanations
+        cached = self.__dict__.get('_train_predictions_fn') is self.predict and self._train_predictions is not None
+        return explanations + (0 if cached else 1)
+
+    def metric_model_calls(self, metrics, explanations=1, approximate=None):
+        """
+        Returns the number of calls of the prediction function the given metrics need besides the explanations.
+        The explanations of cluster neighborhoods predict the whole training set, which serves all metrics.
+
+        :param metrics: names of the metrics
+        :param explanations: number of explanations the metrics are computed for
+        :param approximate: half-width at which the metrics are approximated, None to compute them exactly
+        :return: number of model calls
+        """
+        if self.neighborhood == 'hclust':
+            return 0
+        return super().metric_model_calls(metrics, explanations, approximate)
+
+    def get_nearest_neighbor(self, instance):
+        """
+        Returns the training instance closest to the given instance
+
+        :param instance: one-hot encoded instance as numpy array
+        :return: row index of the training instance
+        """
+        _, indices = self.get_nearest_neighbors().kneighbors(np.asarray(instance, dtype=float).reshape(1, -1))
+        return indices[0, 0]
 
     @xb.utility
     def predict_instance_surrogate(self, instance):
@@ -107,9 +294,67 @@ class DLimeExplainer(Explainer):
         :param instance: instance whose prediction should be provided
         :return: label prediction of given instance
         """
-        return np.clip(self.explanation.intercept[1] + sum(weight * ((instance - self.explainer.scaler.mean_) /
-                                                                     self.explainer.scaler.scale_)[idx]
-                                                           for idx, weight in self.explanation.local_exp[1]), 0, 1)
+        return self.predict_surrogate(instance)
+
+    def predict_surrogate(self, data, explanation=None):
+        """
+        Scores a block of instances with the linear surrogate model of an explanation in one matrix-vector product
+
+        :param data: instances as DataFrame (one-hot encoded or in the Astrapia Dataset format) or numpy array
+            in the one-hot encoded format
+        :param explanation: explanation whose surrogate model is used, defaults to the last explanation
+        :return: numpy array with the clipped surrogate prediction of label 1 for every instance
+        """
+        if explanation is None:
+            explanation = self.explanation
+
+        if isinstance(data, pd.DataFrame):
+            if not set(self.train.columns) <= set(data.columns):
+                data = self.transform_dataset(data, self.data)
+            data = data[self.train.columns]
+        data = np.asarray(data, dtype=float)
+
+        features = np.array([idx for idx, _ in explanation.local_exp[1]], dtype=int)
+        coefficients = np.array([weight for _, weight in explanation.local_exp[1]], dtype=float)
+        scaled = ((data[..., features] - self.explainer.scaler.mean_[features]) /
+                  self.explainer.scaler.scale_[features])
+        return np.clip(explanation.intercept[1] + scaled @ coefficients, 0, 1)
+
+    def predict_train(self, rows=None):
+        """
+        Predicts the training set or some of its rows with the model
+
+        :param rows: sorted index array of training rows, None for all rows
+        :return: predicted probabilities of the rows
+        """
+        return self.predict(self.inverse_transform_dataset(self.train if rows is None else self.train.iloc[rows],
+                                                           self.data))
+
+    @xb.per_explanation
+    def get_neighborhood_labels(self):
+        """
+        Returns the labels the model and the surrogate model assign to the training instances of the neighborhood.
+        They are computed once per explanation and shared by all metrics.
+
+        :return: tuple of boolean numpy arrays aligned with the weights of the neighborhood
+        """
+        ml_preds = self.get_train_predictions(self.neighbors)[:, 1] > 0.5
+        exp_preds = self.predict_surrogate(self.train_matrix[self.neighbors]) > 0.5
+        return ml_preds, exp_preds
+
+    @xb.per_explanation
+    def get_global_labels(self):
+        """
+        Returns the labels the model and the surrogate model assign to all training instances, or to the sampled
+        instances while the metrics are restricted to a subsample. They are computed once per explanation.
+
+        :return: tuple of boolean numpy arrays
+        """
+        if self.kernel_cutoff is None:
+            # the neighborhood consists of exactly these instances
+            return self.get_neighborhood_labels()
+        rows = slice(None) if self.sample is None else self.sample[0]
+        return self.get_train_predictions(rows)[:, 1] > 0.5, self.predict_surrogate(self.train_matrix[rows]) > 0.5
 
     @xb.prop
     def shape(self):
@@ -133,37 +378,51 @@ class DLimeExplainer(Explainer):
         return (kernel_width * np.sqrt(2 * np.pi)) ** kernel_dimension
 
     @xb.metric
+    def samples_used(self):
+        """
+        Number of perturbed samples the surrogate model was fitted on, the neighborhood size lime needed to
+        converge. Only reported if the 'lime' neighborhood is grown adaptively.
+
+        :return: the number of samples
+        """
+        if hasattr(self, 'explanation'):
+            return self.samples
+
+    @xb.metric(estimator='total')
     def coverage(self):
         """
         Proportion of instances covered in the area
         """
-        return sum([weight for _, weight in self.weighted_instances]) / len(self.weighted_instances)
+        return self.weights.sum() / len(self.train_matrix)
 
-    @xb.metric
+    @xb.metric(estimator='total')
     def coverage_absolute(self):
         """
         Number of instances within the neighbourhood.
         """
-        return sum(weight for _, weight in self.weighted_instances)
+        return self.weights.sum()
 
     @xb.metric
+    def truncation_error(self):
+        """
+        Upper bound of the total kernel weight of the training instances below the kernel cut-off, which are left
+        out of the neighborhood. It bounds the error of coverage_absolute and, divided by the size of the training
+        set, the error of coverage. Only reported with a kernel cut-off.
+
+        :return: the error bound
+        """
+        return (len(self.train_matrix) - len(self.weights)) * self.kernel_cutoff
+
+    @xb.metric(estimator='total')
     def distance_furthest(self):
         """
         Highest distance between any two instances that are in the neighborhood of the explanation
 
         :return: distance value
         """
-        kernel_width = np.sqrt(self.train.shape[1]) * .75
-
-        def kernel(distance):
-            return np.sqrt(np.exp(-distance ** 2 / kernel_width ** 2))
+        return (self.distances * self.weights).sum()
 
-        training_instances = self.train.to_numpy()
-        distance_instances = (self.distance(self.instance, instance) for instance in training_instances)
-        weighted_distances = (distance * kernel(distance) for distance in distance_instances)
-        return sum(weighted_distances)
-
-    @xb.metric
+    @xb.metric(cost='model', estimator='ratio')
     def accuracy(self):
         """
         Proportion of instances in the explanation neighborhood that shares the same output label by the
@@ -171,16 +430,11 @@ class DLimeExplainer(Explainer):
 
         :return: the accuracy value
         """
+        ml_preds, exp_preds = self.get_neighborhood_labels()
+        return ((ml_preds == exp_preds) * self.weights).sum() / self.weights.sum()
 
-        ml_preds = self.predict(self.inverse_transform_dataset(self.train, self.data))
-        ml_preds = ml_preds[:, 1] > 0.5
-        exp_preds = [self.predict_instance_surrogate(instance) for instance, _ in self.weighted_instances]
-        exp_preds = np.array(exp_preds) > 0.5
-        weights = np.array([weight for _, weight in self.weighted_instances])
-        return ((ml_preds == exp_preds) * weights).sum() / sum(weights)
 
-
-    @xb.metric
+    @xb.metric(cost='model', estimator='ratio')
     def balance_explanation(self):
         """
         Relative amount of data elements in the explanation neighborhood that had an assigned label value of 1
@@ -190,13 +444,10 @@ class DLimeExplainer(Explainer):
         """
 
         if hasattr(self, 'explanation'):
-            exp_preds = [self.predict_instance_surrogate(instance) for instance, _ in self.weighted_instances]
-            exp_preds = np.array(exp_preds) > 0.5
+            _, exp_preds = self.get_neighborhood_labels()
+            return (exp_preds * self.weights).sum() / self.weights.sum()
 
-            weights = np.array([weight for _, weight in self.weighted_instances])
-            return (exp_preds * weights).sum() / sum(weights)
-
-    @xb.metric
+    @xb.metric(cost='model', estimator='ratio')
     def balance_model(self):
         """
         Relative amount of data elements in the neighborhood of the explanation that had a label value of 1 assigned
@@ -205,13 +456,10 @@ class DLimeExplainer(Explainer):
         :return: the balance value
         """
         if hasattr(self, 'explanation'):
-            ml_preds = self.predict(self.inverse_transform_dataset(self.train, self.data))
-            ml_preds = ml_preds[:, 1] > 0.5
+            ml_preds, _ = self.get_neighborhood_labels()
+            return (ml_preds * self.weights).sum() / self.weights.sum()
 
-            weights = np.array([weight for _, weight in self.weighted_instances])
-            return (ml_preds * weights).sum() / sum(weights)
-
-    @xb.metric
+    @xb.metric(estimator='ratio')
     def balance_data(self):
         """
         Relative amount of data elements in the neighborhood of the explanation with a label value of 1
@@ -219,11 +467,10 @@ class DLimeExplainer(Explainer):
         :return: the balance value
         """
         if hasattr(self, 'explanation'):
-            weights = np.array([weight for _, weight in self.weighted_instances])
-            return sum((self.data.target.to_numpy().reshape((-1,)) == self.data.target_names[1]) * weights) / sum(
-                weights)
+            labels = self.train_labels[self.neighbors]
+            return (labels * self.weights).sum() / self.weights.sum()
 
-    @xb.metric
+    @xb.metric(cost='scan', estimator='total')
     def accuracy_global(self):
         """
         Proportion of instances in the full data space that shares the same output label by the
@@ -231,12 +478,8 @@ class DLimeExplainer(Explainer):
 
         :return: the accuracy value
         """
-
-        ml_preds = self.predict(self.inverse_transform_dataset(self.train, self.data))
-        ml_preds = ml_preds[:, 1] > 0.5
-        exp_preds = [self.predict_instance_surrogate(instance) for instance, _ in self.weighted_instances]
-        exp_preds = np.array(exp_preds) > 0.5
-        return (ml_preds == exp_preds).sum() / len(ml_preds)
+        ml_preds, exp_preds = self.get_global_labels()
+        return np.average(ml_preds == exp_preds, weights=None if self.sample is None else self.sample[1])
 
     @xb.utility
     def distance(self, x, y):
@@ -250,6 +493,7 @@ class DLimeExplainer(Explainer):
         return np.linalg.norm(x - y)
 
     @xb.utility
+    @xb.per_explanation
     def get_weighted_instances(self):
         """
         returns instances associated with their weight concerning the explanation
@@ -257,14 +501,143 @@ class DLimeExplainer(Explainer):
         :return: List of tuples with instance and its weight
         """
         if hasattr(self, 'explanation'):
-            kernel_width = np.sqrt(self.train.shape[1]) * .75
+            return list(zip(self.train_matrix[self.neighbors], self.weights))
+        return []
 
-            def kernel(distance):
-                return np.sqrt(np.exp(-distance ** 2 / kernel_width ** 2))
+    @xb.utility
+    def get_neighborhood_instance(self):
+        """
+        returns the training instances in the neighborhood of the explanation, only provided with a kernel cut-off
 
-            return [(instance, kernel(self.distance(self.instance, instance)))
-                    for instance in self.train.to_numpy()]
-        return []
+        :return: numpy array with one row per instance
+        """
+        return self.train_matrix[self.neighbors]
+
+    @xb.utility
+    def get_neighborhood_distances(self):
+        """
+        returns the distances of the instances in the neighborhood to the explained instance at once, for vectorized
+        transfer functions
+
+        :return: distance vector aligned with get_neighborhood_instance
+        """
+        return self.distances
+
+    @xb.utility
+    def get_neighborhood_weights(self):
+        """
+        returns the kernel weights of the instances in the neighborhood at once, for vectorized transfer functions
+
+        :return: weight vector aligned with get_neighborhood_instance
+        """
+        return self.weights
+
+    def get_strata(self):
+        """
+        Returns the target label of every training instance, which stratifies the subsamples of approximate metrics
+
+        :return: boolean numpy array
+        """
+        return self.train_labels
+
+    @contextlib.contextmanager
+    def restrict_metrics(self, rows, weights):
+        """
+        Context in which the metrics are evaluated on a weighted subsample of the training set
+
+        :param rows: sorted indices of the sampled training instances
+        :param weights: weight of every sampled instance
+        """
+        state = self.sample
+        self.sample = rows, weights
+        try:
+            yield
+        finally:
+            self.sample = state
+
+    def get_neighborhood_sample(self, approximate):
+        """
+        Returns the subsample of the neighborhood the ratio metrics are approximated on, drawn from the instances
+        within the radius of the kernel cut-off or from the whole training set and grown until the kernel weights
+        of the sampled instances suffice for the half-width
+
+        :param approximate: half-width of the 95% confidence interval of proportion metrics
+        :return: the sample and its replicate groups, None to compute the ratio metrics exactly
+        """
+        return self.sample_neighborhood(
+            approximate, None if self.kernel_cutoff is None else self.neighbors,
+            lambda rows: self.kernel(xb.utils.euclidean_distances(self.train_matrix[rows], self.instance,
+                                                                  self.chunk_size)))
+
+    def kernel(self, distances):
+        """
+        Weighs instances by their distance to the explained instance with the exponential kernel of the
+        neighborhood metrics
+
+        :param distances: distance vector
+        :return: weight vector
+        """
+        return np.sqrt(np.exp(-distances ** 2 / self.kernel_width ** 2))
+
+    def get_cutoff_radius(self):
+        """
+        Returns the distance up to which the kernel weight reaches the kernel cut-off
+
+        :return: the radius
+        """
+        # the weight exp(-d^2 / (2 w^2)) of the kernel reaches the cut-off c up to the distance w * sqrt(-2 ln c)
+        return self.kernel_width * np.sqrt(-2 * np.log(self.kernel_cutoff))
+
+    @xb.per_explanation
+    def get_neighborhood(self):
+        """
+        Computes the distances of the training instances to the explained instance and their kernel weights.
+        Without a kernel cut-off all training instances are weighted in one vectorized pass over the training
+        matrix, otherwise only the instances whose weight reaches the cut-off are found by a radius query.
+        While the metrics are restricted to a subsample, the neighborhood consists of the sampled instances (within
+        the radius of the cut-off) and their kernel weights are multiplied with their sample weights.
+        The neighborhood is computed once per explanation and subsample, on first use.
+
+        :return: tuple of the neighborhood as slice or sorted index array of training rows, its distance vector and
+            its weight vector
+        """
+        if self.sample is not None:
+            neighbors, sample_weights = self.sample
+            distances = xb.utils.euclidean_distances(self.train_matrix[neighbors], self.instance, self.chunk_size)
+            if self.kernel_cutoff is not None:
+                inside = distances <= self.get_cutoff_radius()
+                neighbors, distances, sample_weights = neighbors[inside], distances[inside], sample_weights[inside]
+            return neighbors, distances, self.kernel(distances) * sample_weights
+        if self.kernel_cutoff is None:
+            neighbors = slice(None)
+            distances = xb.utils.euclidean_distances(self.train_matrix, self.instance, self.chunk_size)
+        else:
+            (distances,), (indices,) = self.get_nearest_neighbors().radius_neighbors(
+                np.asarray(self.instance, dtype=float).reshape(1, -1), self.get_cutoff_radius())
+            order = np.argsort(indices)
+            neighbors, distances = indices[order], distances[order]
+        return neighbors, distances, self.kernel(distances)
+
+    @property
+    def neighbors(self):
+        """
+        Training rows of the neighborhood of the current explanation as slice or sorted index array
+        """
+        return self.get_neighborhood()[0]
+
+    @property
+    def distances(self):
+        """
+        Distances of the training instances of the neighborhood to the explained instance
+        """
+        return self.get_neighborhood()[1]
+
+    @property
+    def weights(self):
+        """
+        Kernel weights of the training instances of the neighborhood
+        """
+        return self.get_neighborhood()[2]
 
     @xb.utility
     def get_explained_instance(self):
@@ -1,25 +1,214 @@
+import contextlib
+import hashlib
+import os
+
 import lime
 import lime.lime_tabular
 import numpy as np
 import pandas as pd
+import scipy.stats
+from sklearn.neighbors import NearestNeighbors
 
 import astrapia as xb
 from astrapia import Explainer
 
 
+class NeighborhoodLimeTabularExplainer(lime.lime_tabular.LimeTabularExplainer):
+    """
+    LimeTabularExplainer whose neighborhood sampling can be separated from fitting the surrogate model.
+    A neighborhood returned by sample_neighborhood can be assigned to the neighborhood attribute, the next
+    call of explain_instance then fits its surrogate model on it instead of sampling a new one.
+
+    With sampler='sobol' or 'halton' the neighborhoods are drawn from a scrambled low-discrepancy sequence instead of
+    pseudo-random numbers, mapped through the same inverse CDFs.
+    """
+
+    neighborhood = None
+
+    def __init__(self, *args, sampler='random', **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sampler = sampler
+
+    def sample_neighborhood(self, data_row, num_samples=5000):
+        """
+        Samples the neighborhood lime would use to explain the given row
+
+        :param data_row: instance as one-dimensional numpy array
+        :param num_samples: size of the neighborhood
+        :return: tuple of the neighborhood in the interpretable representation and in the original representation
+        """
+        return self._LimeTabularExplainer__data_inverse(data_row, num_samples)
+
+    def sample_quasi_random(self, data_row, num_samples=5000):
+        """
+        Samples a neighborhood like lime, but maps the points of a low-discrepancy sequence through the inverse CDFs
+        of lime's distributions: the normal distribution of continuous features, the training distribution of
+        categorical features and the truncated normal distribution of the values within a bin
+
+        :param data_row: instance as one-dimensional numpy array
+        :param num_samples: size of the neighborhood
+        :return: tuple of the neighborhood in the interpretable representation and in the original representation
+        """
+        num_cols = data_row.shape[0]
+        categorical_features = list(range(num_cols) if self.discretizer is not None else self.categorical_features)
+        uniform = xb.utils.quasi_random_uniform(self.sampler, num_samples, num_cols + len(categorical_features),
+                                                self.random_state)
+
+        if self.discretizer is None:
+            center = data_row if self.sample_around_instance else self.scaler.mean_
+            data = scipy.stats.norm.ppf(uniform[:, :num_cols]) * self.scaler.scale_ + center
+            first_row = data_row
+        else:
+            data = np.zeros((num_samples, num_cols))
+            first_row = self.discretizer.discretize(data_row)
+        data[0] = data_row
+        inverse = data.copy()
+
+        for idx, column in enumerate(categorical_features):
+            values = np.asarray(self.feature_values[column])
+            cdf = np.cumsum(self.feature_frequencies[column])
+            indices = np.minimum(np.searchsorted(cdf / cdf[-1], uniform[:, num_cols + idx], side='right'),
+                                 len(values) - 1)
+            inverse[:, column] = values[indices]
+            data[:, column] = inverse[:, column] == first_row[column]
+        data[0, categorical_features] = 1
+
+        if self.discretizer is not None:
+            for column in self.discretizer.means:
+                bins = inverse[1:, column].astype(int)
+                means, stds, mins, maxs = (np.asarray(stats[column])[bins] for stats in
+                                           (self.discretizer.means, self.discretizer.stds,
+                                            self.discretizer.mins, self.discretizer.maxs))
+                with np.errstate(invalid='ignore'):
+                    values = scipy.stats.truncnorm.ppf(uniform[1:, column], (mins - means) / stds,
+                                                       (maxs - means) / stds, loc=means, scale=stds)
+                # bins holding a single value have an empty range
+                inverse[1:, column] = np.where(mins < maxs, values, mins)
+        inverse[0] = data_row
+        return data, inverse
+
+    def sample_pool(self, pool_size, pool_path=None, block_rows=100000, random_state=None):
+        """
+        Samples perturbations that do not depend on the explained instance. Like lime's neighborhoods, continuous
+        features are drawn around the training mean and categorical (or discretized) features from their training
+        distribution, so a neighborhood of any instance can be taken from the pool by binarizing its rows.
+
+        :param pool_size: number of perturbations
+        :param pool_path: directory in which the pool is stored as memory-mapped .npy files, None to keep it in memory.
+            A pool of the same size that was completely stored in the directory before is reused instead of sampled.
+        :param block_rows: number of perturbations sampled at once
+        :param random_state: numpy RandomState the pool is sampled from, None for lime's random state
+        :return: tuple of the perturbations in the original representation and the sampled values of the
+            categorical features
+        """
+        if self.discretizer is None and self.sample_around_instance:
+            raise ValueError('A perturbation pool requires sample_around_instance=False or a discretizer')
+
+        if random_state is None:
+            random_state = self.random_state
+        categorical_features = list(self.categorical_features)
+        shapes = {'inverse': (pool_size, len(self.scaler.scale_)), 'codes': (pool_size, len(categorical_features))}
+        if pool_path is None:
+            inverse, codes = (np.empty(shape) for shape in shapes.values())
+        else:
+            paths = [os.path.join(pool_path, f'{name}.npy') for name in shapes]
+            if all(os.path.exists(path) for path in paths):
+                inverse, codes = (np.lib.format.open_memmap(path, mode='r') for path in paths)
+                if (inverse.shape, codes.shape) == tuple(shapes.values()):
+                    return inverse, codes
+            os.makedirs(pool_path, exist_ok=True)
+            # the pool is written to temporary files first, so that an interrupted pool is never reused
+            inverse, codes = (np.lib.format.open_memmap(path + '.tmp', mode='w+', dtype=float, shape=shape)
+                              for path, shape in zip(paths, shapes.values()))
+
+        for start in range(0, pool_size, block_rows):
+            size = min(block_rows, pool_size - start)
+            block = np.zeros((size, inverse.shape[1]))
+            if self.discretizer is None:
+                block = random_state.normal(0, 1, block.size).reshape(block.shape) * self.scaler.scale_ + \
+                        self.scaler.mean_
+            for idx, column in enumerate(categorical_features):
+                codes[start:start + size, idx] = random_state.choice(self.feature_values[column], size=size,
+                                                                      replace=True, p=self.feature_frequencies[column])
+            block[:, categorical_features] = codes[start:start + size]
+            if self.discretizer is not None:
+                # the discretizer samples the values within the bins from its own random state
+                discretizer_state, self.discretizer.random_state = self.discretizer.random_state, random_state
+                try:
+                    block = self.discretizer.undiscretize(block)
+                finally:
+                    self.discretizer.random_state = discretizer_state
+            inverse[start:start + size] = block
+
+        if pool_path is not None:
+            for array, path in zip((inverse, codes), paths):
+                array.flush()
+                os.replace(path + '.tmp', path)
+        return inverse, codes
+
+    def pool_neighborhood(self, data_row, inverse, codes):
+        """
+        Builds the neighborhood of an instance from perturbations of a pool, binarizing the categorical features
+        against the instance as lime does
+
+        :param data_row: instance as one-dimensional numpy array
+        :param inverse: perturbations of the pool in the original representation
+        :param codes: sampled values of the categorical features of the perturbations
+        :return: tuple of the neighborhood in the interpretable representation and in the original representation,
+            the first row is the instance
+        """
+        categorical_features = list(self.categorical_features)
+        first_row = data_row if self.discretizer is None else self.discretizer.discretize(data_row)
+
+        inverse = np.vstack([data_row, inverse])
+        data = inverse.copy()
+        data[1:, categorical_features] = codes == first_row[categorical_features]
+        data[0, categorical_features] = 1
+        return data, inverse
+
+    def _LimeTabularExplainer__data_inverse(self, *args, **kwargs):
+        if self.neighborhood is not None:
+            neighborhood, self.neighborhood = self.neighborhood, None
+            return neighborhood
+        if self.sampler != 'random':
+            return self.sample_quasi_random(*args, **kwargs)
+        return super()._LimeTabularExplainer__data_inverse(*args, **kwargs)
+
+
 class LimeExplainer(Explainer):
     """
     Implementation of the Lime Explainer onto the base Explainer class
     """
 
-    def __init__(self, data, predict_fn, discretize_continuous=True):
+    def __init__(self, data, predict_fn, discretize_continuous=True, chunk_size=None, pool_size=None,
+                 pool_path=None, batch_rows=100000, tolerance=None, min_samples=500, top_k=5, sampler='random',
+                 kernel_cutoff=None):
         """
         Initializes a Lime explainer
 
         :param data: data that is supposed to be explained
         :param predict_fn: classification model that is supposed to be explained
         :param discretize_continuous: should continuous values be separated into discrete categories
-        """
+        :param chunk_size: number of training rows per vectorized distance computation, None for all rows at once
+        :param pool_size: number of perturbations of a pool that is sampled and predicted once and shared by all
+            explanations, None to sample and predict a new neighborhood per explanation
+        :param pool_path: directory in which the perturbation pool is memory-mapped, None to keep it in memory.
+            The pool is stored per training set and seed and reused by later explainers of the same training set,
+            only its model predictions are computed again.
+        :param batch_rows: maximum number of perturbed rows per model call when predicting the pool
+        :param tolerance: maximum change of the surrogate coefficients at which an adaptively grown neighborhood is
+            considered converged, None to always sample num_samples perturbations
+        :param min_samples: size of the first batch of an adaptively grown neighborhood
+        :param top_k: number of highest ranked features whose ranking and coefficients have to be stable for an
+            adaptively grown neighborhood to be considered converged, None for all selected features
+        :param sampler: 'random' samples neighborhoods from pseudo-random numbers, 'sobol' or 'halton' from a
+            scrambled low-discrepancy sequence, whose explanations fluctuate less for the same number of samples
+        :param kernel_cutoff: kernel weight below which training instances are left out of the neighborhood
+            metrics, so that they are computed from a radius query instead of the whole training set, None to
+            weight all training instances
+        """
+        if tolerance is not None and pool_size is not None:
+            raise ValueError('Adaptive sampling cannot be combined with a perturbation pool')
 
         self.categorical_features = data.categorical_features
         self.data_keys = data.data.keys()
@@ -28,14 +217,36 @@ class LimeExplainer(Explainer):
         self.train = self.transform_dataset(data.data, data)
         self.dev = self.transform_dataset(data.data_dev, data)
         self.test = self.transform_dataset(data.data_test, data)
+        self.train_matrix = self.train.to_numpy(dtype=float)
+        self.chunk_size = chunk_size
 
-        self.explainer = lime.lime_tabular.LimeTabularExplainer(self.train, feature_names=self.train.keys(),
-                                                                class_names=data.target_names,
-                                                                categorical_features=None,
-                                                                discretize_continuous=discretize_continuous)
+        self.explainer = NeighborhoodLimeTabularExplainer(self.train_matrix, feature_names=self.train.keys(),
+                                                          class_names=data.target_names,
+                                                          categorical_features=None,
+                                                          discretize_continuous=discretize_continuous,
+                                                          sampler=sampler)
 
         self.predict = predict_fn
         self.kernel_width = np.sqrt(self.train.shape[1]) * .75
+        self.kernel_cutoff = kernel_cutoff
+        if kernel_cutoff is None:
+            # without a cut-off the neighborhood is the whole training set, nothing is truncated and the transfer
+            # functions over its arrays would only describe the training set
+            self.get_neighborhood_instance = self.get_neighborhood_distances = self.get_neighborhood_weights = None
+            self.truncation_error = None
+        self.sample = None
+        self._nearest_neighbors = None
+        self.train_labels = data.target.to_numpy().reshape((-1,)) == data.target_names[1]
+
+        self.pool_size = pool_size
+        self.pool_path = pool_path
+        self.batch_rows = batch_rows
+        self.tolerance = tolerance
+        if tolerance is None:
+            # the neighborhood only varies in size if it is grown adaptively
+            self.samples_used = None
+        self.min_samples = min_samples
+        self.top_k = top_k
 
     def transform_dataset(self, data: pd.DataFrame, meta: xb.Dataset) -> any:
         """
@@ -48,42 +259,170 @@ class LimeExplainer(Explainer):
 
         return xb.utils.onehot_encode(data, meta)
 
-    def inverse_transform_dataset(self, data: pd.DataFrame, meta: xb.Dataset):
+    def inverse_transform_dataset(self, data, meta: xb.Dataset):
         """
         Inverse transform an explainer-specific dataset into the general Astrapia Dataset format
 
-        :param data: pandas dataframe holding data in the shape LIME needs it
+        :param data: pandas dataframe or numpy array holding data in the shape LIME needs it
         :param meta: Astrapia Dataset object holding meta information that does not depend on data instances
         :returns: pandas dataframe in Astrapia Dataset format
         """
-        df = pd.DataFrame(index=data.index)
-        for feature in meta.categorical_features:
-            max_indices = np.argmax(
-                data[[feature + '_' + str(l) for l in meta.categorical_features[feature]]].to_numpy(), axis=1)
-            df[feature] = pd.Series([meta.categorical_features[feature][f] for f in max_indices], index=data.index)
-
-        continuous = list(meta.feature_names - meta.categorical_features.keys())
-        df[continuous] = data[continuous]
-        return df[meta.data.keys()]
+        return xb.utils.onehot_decode(data, meta)
 
-    def explain_instance(self, instance, num_features=10):
+    def explain_instance(self, instance, num_features=10, num_samples=5000):
         """
         Creates a dlime explanation based on a given instance
 
         :param instance: instance as dataframe
         :param num_features: amount of features in the dataset
+        :param num_samples: size of the neighborhood lime samples around the instance, the maximum size if the
+            neighborhood is grown adaptively
         :return: the explanation
         """
 
-        instance = self.transform_dataset(instance, self.data).iloc[0]
-        self.explanation = self.explainer.explain_instance(
-            instance, lambda x: self.predict(self.inverse_transform_dataset(
-                pd.DataFrame(x, columns=self.train.keys()), self.data)), num_features=num_features)
+        instance = self.data.onehot.encode_row(instance)
+        predict_fn = lambda x: self.predict(self.inverse_transform_dataset(x, self.data))
+        if self.tolerance is not None:
+            self.explanation, self.samples = xb.utils.explain_adaptively(
+                lambda size: self.explainer.sample_neighborhood(instance, size), predict_fn,
+                lambda data, inverse, yss: self.explain_neighborhood(instance, (data, inverse), yss, num_features),
+                num_samples, self.min_samples, self.tolerance, top_k=self.top_k)
+        else:
+            if self.pool_size is not None:
+                self.explainer.neighborhood, yss = self.get_pool_neighborhood(instance, num_samples)
+                predict_fn = lambda x: yss
+
+            self.explanation = self.explainer.explain_instance(instance, predict_fn, num_features=num_features,
+                                                               num_samples=num_samples)
+            self.samples = num_samples if self.pool_size is None else len(yss)
         self.instance = instance
-        self.weighted_instances = self.get_weighted_instances()
 
         return self.explanation
 
+    def explain_instances(self, instances, num_features=10, num_samples=5000, batch_rows=100000):
+        """
+        Creates lime explanations for a batch of instances. The neighborhoods of as many instances as fit into
+        batch_rows are sampled first and predicted by the model in a single call, then the surrogate models are
+        fitted one by one. Neighborhoods are sampled in the same order as by consecutive calls of explain_instance,
+        so the explanations are identical for the same seed. Afterwards the explainer holds the last explanation.
+        Adaptively grown neighborhoods are sampled and predicted batch by batch for every instance.
+
+        :param instances: instances as dataframe
+        :param num_features: amount of features in the dataset
+        :param num_samples: size of the neighborhood lime samples around every instance
+        :param batch_rows: maximum number of perturbed rows per model call, at least one neighborhood is predicted
+            per call. With a perturbation pool only the instances are predicted, batch_rows of them per call.
+        :return: list of explanations in the order of the instances
+        """
+        if self.tolerance is not None:
+            return [self.explain_instance(instances.iloc[[idx]], num_features, num_samples)
+                    for idx in range(len(instances))]
+
+        rows = self.data.onehot.encode_array(instances)
+        # with a perturbation pool only the instances themselves are predicted
+        rows_per_instance = num_samples if self.pool_size is None else 1
+        instances_per_call = max(1, batch_rows // rows_per_instance)
+
+        explanations = []
+        for start in range(0, len(rows), instances_per_call):
+            batch = rows[start:start + instances_per_call]
+            if self.pool_size is None:
+                neighborhoods = [self.explainer.sample_neighborhood(row, num_samples) for row in batch]
+                predictions = np.asarray(self.predict(self.inverse_transform_dataset(
+                    np.concatenate([inverse for _, inverse in neighborhoods]), self.data)))
+                labels = np.split(predictions, len(batch))
+            else:
+                predictions = np.asarray(self.predict(self.inverse_transform_dataset(batch, self.data)))
+                neighborhoods, labels = zip(*[self.get_pool_neighborhood(row, num_samples, prediction)
+                                              for row, prediction in zip(batch, predictions)])
+
+            for row, neighborhood, yss in zip(batch, neighborhoods, labels):
+                self.explanation = self.explain_neighborhood(row, neighborhood, yss, num_features)
+                explanations.append(self.explanation)
+
+        if explanations:
+            self.instance = rows[-1]
+            self.samples = len(yss)
+        return explanations
+
+    def explain_neighborhood(self, instance, neighborhood, yss, num_features=10):
+        """
+        Fits the lime surrogate model of an instance on a sampled neighborhood whose predictions are known
+
+        :param instance: one-hot encoded instance as numpy array
+        :param neighborhood: tuple of the neighborhood in the interpretable and in the original representation
+        :param yss: model predictions of the neighborhood
+        :param num_features: amount of features in the dataset
+        :return: the explanation
+        """
+        self.explainer.neighborhood = neighborhood
+        return self.explainer.explain_instance(instance, lambda x: yss, num_features=num_features,
+                                               num_samples=len(yss))
+
+    def warm_up(self, seed=None):
+        """
+        Builds the ball tree of a truncated kernel and samples and predicts the perturbation pool
+
+        :param seed: seed the perturbation pool is sampled from, None for lime's random state
+        """
+        if self.kernel_cutoff is not None:
+            self.get_nearest_neighbors()
+        if self.pool_size is not None:
+            self.get_pool(seed)
+
+    def get_pool(self, seed=None):
+        """
+        Returns the perturbation pool and its model predictions. The pool is sampled and predicted once and shared
+        by all explanations until the prediction function of the explainer is replaced or a pool of another seed
+        is requested.
+
+        :param seed: seed the pool is sampled from, None for lime's random state or the pool sampled before
+        :return: tuple of the perturbations, the sampled values of their categorical features and their predictions
+        """
+        if getattr(self, '_pool_fn', None) is not self.predict or seed is not None and seed != self._pool_seed:
+            pool_path = None
+            if self.pool_path is not None:
+                # the pool depends on the distributions of the training set and on its seed, so it is stored per
+                # training set and seed
+                pool_path = os.path.join(self.pool_path, hashlib.sha1(
+                    np.ascontiguousarray(self.train_matrix).tobytes() +
+                    repr((list(self.train.columns), self.explainer.discretizer is not None, seed)).encode()
+                ).hexdigest())
+            inverse, codes = self.explainer.sample_pool(
+                self.pool_size, pool_path, random_state=None if seed is None else np.random.RandomState(seed))
+            predictions = np.concatenate([
+                np.asarray(self.predict(self.inverse_transform_dataset(inverse[start:start + self.batch_rows],
+                                                                       self.data)))
+                for start in range(0, self.pool_size, self.batch_rows)])
+            self._pool = inverse, codes, predictions
+            self._pool_fn = self.predict
+            self._pool_seed = seed
+        return self._pool
+
+    def get_pool_neighborhood(self, instance, num_samples, instance_prediction=None):
+        """
+        Draws the neighborhood of an instance from the perturbation pool
+
+        :param instance: one-hot encoded instance as numpy array
+        :param num_samples: size of the neighborhood including the instance
+        :param instance_prediction: model prediction of the instance, predicted if not given
+        :return: tuple of the neighborhood as returned by sample_neighborhood and its model predictions
+        """
+        inverse, codes, predictions = self.get_pool()
+        if self.pool_size > num_samples - 1:
+            # a generator draws the rows in O(num_samples) instead of permuting the whole pool, it is seeded from
+            # lime's random state, so that seeding lime still fixes the neighborhood
+            rng = np.random.default_rng(self.explainer.random_state.randint(np.iinfo(np.int32).max))
+            rows = np.sort(rng.choice(self.pool_size, num_samples - 1, replace=False, shuffle=False))
+        else:
+            rows = np.arange(self.pool_size)
+
+        if instance_prediction is None:
+            instance_prediction = np.asarray(self.predict(self.inverse_transform_dataset(
+                instance.reshape(1, -1), self.data)))[0]
+        neighborhood = self.explainer.pool_neighborhood(instance, inverse[rows], codes[rows])
+        return neighborhood, np.vstack([instance_prediction, predictions[rows]])
+
     def predict_instance_surrogate(self, instance):
         """
         Helper function for accessing the predictions of lime's surrogate model
@@ -91,9 +430,67 @@ class LimeExplainer(Explainer):
         :param instance: instance whose prediction should be provided
         :return: label prediction of given instance
         """
-        return np.clip(self.explanation.intercept[1] + sum(weight * ((instance - self.explainer.scaler.mean_) /
-                                                                     self.explainer.scaler.scale_)[idx]
-                                                           for idx, weight in self.explanation.local_exp[1]), 0, 1)
+        return self.predict_surrogate(instance)
+
+    def predict_surrogate(self, data, explanation=None):
+        """
+        Scores a block of instances with the linear surrogate model of an explanation in one matrix-vector product
+
+        :param data: instances as DataFrame (one-hot encoded or in the Astrapia Dataset format) or numpy array
+            in the one-hot encoded format
+        :param explanation: explanation whose surrogate model is used, defaults to the last explanation
+        :return: numpy array with the clipped surrogate prediction of label 1 for every instance
+        """
+        if explanation is None:
+            explanation = self.explanation
+
+        if isinstance(data, pd.DataFrame):
+            if not set(self.train.columns) <= set(data.columns):
+                data = self.transform_dataset(data, self.data)
+            data = data[self.train.columns]
+        data = np.asarray(data, dtype=float)
+
+        features = np.array([idx for idx, _ in explanation.local_exp[1]], dtype=int)
+        coefficients = np.array([weight for _, weight in explanation.local_exp[1]], dtype=float)
+        scaled = ((data[..., features] - self.explainer.scaler.mean_[features]) /
+                  self.explainer.scaler.scale_[features])
+        return np.clip(explanation.intercept[1] + scaled @ coefficients, 0, 1)
+
+    def predict_train(self, rows=None):
+        """
+        Predicts the training set or some of its rows with the model
+
+        :param rows: sorted index array of training rows, None for all rows
+        :return: predicted probabilities of the rows
+        """
+        return self.predict(self.inverse_transform_dataset(self.train if rows is None else self.train.iloc[rows],
+                                                           self.data))
+
+    @xb.per_explanation
+    def get_neighborhood_labels(self):
+        """
+        Returns the labels the model and the surrogate model assign to the training instances of the neighborhood.
+        They are computed once per explanation and shared by all metrics.
+
+        :return: tuple of boolean numpy arrays aligned with the weights of the neighborhood
+        """
+        ml_preds = self.get_train_predictions(self.neighbors)[:, 1] > 0.5
+        exp_preds = self.predict_surrogate(self.train_matrix[self.neighbors]) > 0.5
+        return ml_preds, exp_preds
+
+    @xb.per_explanation
+    def get_global_labels(self):
+        """
+        Returns the labels the model and the surrogate model assign to all training instances, or to the sampled
+        instances while the metrics are restricted to a subsample. They are computed once per explanation.
+
+        :return: tuple of boolean numpy arrays
+        """
+        if self.kernel_cutoff is None:
+            # the neighborhood consists of exactly these instances
+            return self.get_neighborhood_labels()
+        rows = slice(None) if self.sample is None else self.sample[0]
+        return self.get_train_predictions(rows)[:, 1] > 0.5, self.predict_surrogate(self.train_matrix[rows]) > 0.5
 
     @xb.prop
     def shape(self):
@@ -119,41 +516,55 @@ class LimeExplainer(Explainer):
         return (kernel_width * np.sqrt(2 * np.pi)) ** kernel_dimension
 
     @xb.metric
+    def samples_used(self):
+        """
+        Number of perturbed samples the surrogate model was fitted on, the neighborhood size lime needed to
+        converge. Only reported if the neighborhood is grown adaptively.
+
+        :return: the number of samples
+        """
+        if hasattr(self, 'explanation'):
+            return self.samples
+
+    @xb.metric(estimator='total')
     def coverage(self):
         """
         Proportion of instances covered in the area
 
         :return: the coverage value
         """
-        return sum([weight for _, weight in self.weighted_instances]) / len(self.weighted_instances)
+        return self.weights.sum() / len(self.train_matrix)
 
-    @xb.metric
+    @xb.metric(estimator='total')
     def coverage_absolute(self):
         """
         Number of instances within the neighbourhood.
 
         :return: the coverage value
         """
-        return sum(weight for _, weight in self.weighted_instances)
+        return self.weights.sum()
 
     @xb.metric
+    def truncation_error(self):
+        """
+        Upper bound of the total kernel weight of the training instances below the kernel cut-off, which are left
+        out of the neighborhood. It bounds the error of coverage_absolute and, divided by the size of the training
+        set, the error of coverage. Only reported with a kernel cut-off.
+
+        :return: the error bound
+        """
+        return (len(self.train_matrix) - len(self.weights)) * self.kernel_cutoff
+
+    @xb.metric(estimator='total')
     def distance_furthest(self):
         """
         Highest distance between any two instances that are in the neighborhood of the explanation
 
         :return: distance value
         """
-        kernel_width = np.sqrt(self.train.shape[1]) * .75
+        return (self.distances * self.weights).sum()
 
-        def kernel(distance):
-            return np.sqrt(np.exp(-distance ** 2 / kernel_width ** 2))
-
-        training_instances = self.train.to_numpy()
-        distance_instances = (self.distance(self.instance, instance) for instance in training_instances)
-        weighted_distances = (distance * kernel(distance) for distance in distance_instances)
-        return sum(weighted_distances)
-
-    @xb.metric
+    @xb.metric(cost='model', estimator='ratio')
     def accuracy(self):
         """
         Proportion of instances in the explanation neighborhood that shares the same output label by the
@@ -161,15 +572,10 @@ class LimeExplainer(Explainer):
 
         :return: the accuracy value
         """
+        ml_preds, exp_preds = self.get_neighborhood_labels()
+        return ((ml_preds == exp_preds) * self.weights).sum() / self.weights.sum()
 
-        ml_preds = self.predict(self.inverse_transform_dataset(self.train, self.data))
-        ml_preds = ml_preds[:, 1] > 0.5
-        exp_preds = [self.predict_instance_surrogate(instance) for instance, _ in self.weighted_instances]
-        exp_preds = np.array(exp_preds) > 0.5
-        weights = np.array([weight for _, weight in self.weighted_instances])
-        return ((ml_preds == exp_preds) * weights).sum() / sum(weights)
-
-    @xb.metric
+    @xb.metric(cost='model', estimator='ratio')
     def balance_explanation(self):
         """
         Relative amount of data elements in the explanation neighborhood that had an assigned label value of 1
@@ -179,13 +585,10 @@ class LimeExplainer(Explainer):
         """
 
         if hasattr(self, 'explanation'):
-            exp_preds = [self.predict_instance_surrogate(instance) for instance, _ in self.weighted_instances]
-            exp_preds = np.array(exp_preds) > 0.5
-
-            weights = np.array([weight for _, weight in self.weighted_instances])
-            return (exp_preds * weights).sum() / sum(weights)
+            _, exp_preds = self.get_neighborhood_labels()
+            return (exp_preds * self.weights).sum() / self.weights.sum()
 
-    @xb.metric
+    @xb.metric(cost='model', estimator='ratio')
     def balance_model(self):
         """
         Relative amount of data elements in the neighborhood of the explanation that had a label value of 1 assigned
@@ -194,13 +597,10 @@ class LimeExplainer(Explainer):
         :return: the balance value
         """
         if hasattr(self, 'explanation'):
-            ml_preds = self.predict(self.inverse_transform_dataset(self.train, self.data))
-            ml_preds = ml_preds[:, 1] > 0.5
-
-            weights = np.array([weight for _, weight in self.weighted_instances])
-            return (ml_preds * weights).sum() / sum(weights)
+            ml_preds, _ = self.get_neighborhood_labels()
+            return (ml_preds * self.weights).sum() / self.weights.sum()
 
-    @xb.metric
+    @xb.metric(estimator='ratio')
     def balance_data(self):
         """
         Relative amount of data elements in the neighborhood of the explanation with a label value of 1
@@ -208,11 +608,10 @@ class LimeExplainer(Explainer):
         :return: the balance value
         """
         if hasattr(self, 'explanation'):
-            weights = np.array([weight for _, weight in self.weighted_instances])
-            return sum((self.data.target.to_numpy().reshape((-1,)) == self.data.target_names[1]) * weights) / sum(
-                weights)
+            labels = self.train_labels[self.neighbors]
+            return (labels * self.weights).sum() / self.weights.sum()
 
-    @xb.metric
+    @xb.metric(cost='scan', estimator='total')
     def accuracy_global(self):
         """
         Proportion of instances in the full data space that shares the same output label by the
@@ -220,11 +619,8 @@ class LimeExplainer(Explainer):
 
         :return: the accuracy value
         """
-        ml_preds = self.predict(self.inverse_transform_dataset(self.train, self.data))
-        ml_preds = ml_preds[:, 1] > 0.5
-        exp_preds = [self.predict_instance_surrogate(instance) for instance, _ in self.weighted_instances]
-        exp_preds = np.array(exp_preds) > 0.5
-        return (ml_preds == exp_preds).sum() / len(ml_preds)
+        ml_preds, exp_preds = self.get_global_labels()
+        return np.average(ml_preds == exp_preds, weights=None if self.sample is None else self.sample[1])
 
     @xb.utility
     def distance(self, x, y):
@@ -238,6 +634,7 @@ class LimeExplainer(Explainer):
         return np.linalg.norm(x - y)
 
     @xb.utility
+    @xb.per_explanation
     def get_weighted_instances(self):
         """
         returns instances associated with their weight concerning the explanation
@@ -245,14 +642,154 @@ class LimeExplainer(Explainer):
         :return: List of tuples with instance and its weight
         """
         if hasattr(self, 'explanation'):
-            kernel_width = np.sqrt(self.train.shape[1]) * .75
+            return list(zip(self.train_matrix[self.neighbors], self.weights))
+        return []
 
-            def kernel(distance):
-                return np.sqrt(np.exp(-distance ** 2 / kernel_width ** 2))
+    @xb.utility
+    def get_neighborhood_instance(self):
+        """
+        returns the training instances in the neighborhood of the explanation, only provided with a kernel cut-off
 
-            return [(instance, kernel(self.distance(self.instance, instance)))
-                    for instance in self.train.to_numpy()]
-        return []
+        :return: numpy array with one row per instance
+        """
+        return self.train_matrix[self.neighbors]
+
+    @xb.utility
+    def get_neighborhood_distances(self):
+        """
+        returns the distances of the instances in the neighborhood to the explained instance at once, for vectorized
+        transfer functions
+
+        :return: distance vector aligned with get_neighborhood_instance
+        """
+        return self.distances
+
+    @xb.utility
+    def get_neighborhood_weights(self):
+        """
+        returns the kernel weights of the instances in the neighborhood at once, for vectorized transfer functions
+
+        :return: weight vector aligned with get_neighborhood_instance
+        """
+        return self.weights
+
+    def get_nearest_neighbors(self):
+        """
+        Returns the ball tree over the training matrix that answers the radius queries of a truncated kernel.
+        It is built on first use.
+
+        :return: fitted NearestNeighbors index
+        """
+        if self._nearest_neighbors is None:
+            self._nearest_neighbors = NearestNeighbors(algorithm='ball_tree').fit(self.train_matrix)
+        return self._nearest_neighbors
+
+    def get_strata(self):
+        """
+        Returns the target label of every training instance, which stratifies the subsamples of approximate metrics
+
+        :return: boolean numpy array
+        """
+        return self.train_labels
+
+    @contextlib.contextmanager
+    def restrict_metrics(self, rows, weights):
+        """
+        Context in which the metrics are evaluated on a weighted subsample of the training set
+
+        :param rows: sorted indices of the sampled training instances
+        :param weights: weight of every sampled instance
+        """
+        state = self.sample
+        self.sample = rows, weights
+        try:
+            yield
+        finally:
+            self.sample = state
+
+    def get_neighborhood_sample(self, approximate):
+        """
+        Returns the subsample of the neighborhood the ratio metrics are approximated on, drawn from the instances
+        within the radius of the kernel cut-off or from the whole training set and grown until the kernel weights
+        of the sampled instances suffice for the half-width
+
+        :param approximate: half-width of the 95% confidence interval of proportion metrics
+        :return: the sample and its replicate groups, None to compute the ratio metrics exactly
+        """
+        return self.sample_neighborhood(
+            approximate, None if self.kernel_cutoff is None else self.neighbors,
+            lambda rows: self.kernel(xb.utils.euclidean_distances(self.train_matrix[rows], self.instance,
+                                                                  self.chunk_size)))
+
+    def kernel(self, distances):
+        """
+        Weighs instances by their distance to the explained instance with the exponential kernel of the
+        neighborhood metrics
+
+        :param distances: distance vector
+        :return: weight vector
+        """
+        return np.sqrt(np.exp(-distances ** 2 / self.kernel_width ** 2))
+
+    def get_cutoff_radius(self):
+        """
+        Returns the distance up to which the kernel weight reaches the kernel cut-off
+
+        :return: the radius
+        """
+        # the weight exp(-d^2 / (2 w^2)) of the kernel reaches the cut-off c up to the distance w * sqrt(-2 ln c)
+        return self.kernel_width * np.sqrt(-2 * np.log(self.kernel_cutoff))
+
+    @xb.per_explanation
+    def get_neighborhood(self):
+        """
+        Computes the distances of the training instances to the explained instance and their kernel weights.
+        Without a kernel cut-off all training instances are weighted in one vectorized pass over the training
+        matrix, otherwise only the instances whose weight reaches the cut-off are found by a radius query.
+        While the metrics are restricted to a subsample, the neighborhood consists of the sampled instances (within
+        the radius of the cut-off) and their kernel weights are multiplied with their sample weights.
+        The neighborhood is computed once per explanation and subsample, on first use.
+
+        :return: tuple of the neighborhood as slice or sorted index array of training rows, its distance vector and
+            its weight vector
+        """
+        if self.sample is not None:
+            neighbors, sample_weights = self.sample
+            distances = xb.utils.euclidean_distances(self.train_matrix[neighbors], self.instance, self.chunk_size)
+            if self.kernel_cutoff is not None:
+                inside = distances <= self.get_cutoff_radius()
+                neighbors, distances, sample_weights = neighbors[inside], distances[inside], sample_weights[inside]
+            return neighbors, distances, self.kernel(distances) * sample_weights
+        if self.kernel_cutoff is None:
+            neighbors = slice(None)
+            distances = xb.utils.euclidean_distances(self.train_matrix, self.instance, self.chunk_size)
+        else:
+            (distances,), (indices,) = self.get_nearest_neighbors().radius_neighbors(
+                np.asarray(self.instance, dtype=float).reshape(1, -1), self.get_cutoff_radius())
+            order = np.argsort(indices)
+            neighbors, distances = indices[order], distances[order]
+        return neighbors, distances, self.kernel(distances)
+
+    @property
+    def neighbors(self):
+        """
+        Training rows of the neighborhood of the current explanation as slice or sorted index array
+        """
+        return self.get_neighborhood()[0]
+
+    @property
+    def distances(self):
+        """
+        Distances of the training instances of the neighborhood to the explained instance
+        """
+        return self.get_neighborhood()[1]
+
+    @property
+    def weights(self):
+        """
+        Kernel weights of the training instances of the neighborhood
+        """
+        return self.get_neighborhood()[2]
 
     @xb.utility
     def get_explained_instance(self):
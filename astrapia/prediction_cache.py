@@ -0,0 +1,138 @@
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+import pandas as pd
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'evictions', 'maxsize', 'currsize'])
+
+
+class PredictionCache:
+    """
+    Wraps a prediction function and serves predictions of rows that were already seen from a bounded LRU cache.
+    The wrapper can be used as prediction function of any explainer or sampler. Sharing one instance between
+    all explainers of a comparator ensures that the model is only called for rows it has never seen.
+
+    Rows are identified by their values, so the cache expects the rows to be passed in the same format (column
+    order) every time, e.g. the general Astrapia Dataset format. Rows with missing values are never cached.
+
+    Most rows an explainer predicts are random perturbations that are never seen again, so the default size only
+    keeps the recently predicted rows that are likely to repeat, e.g. explained instances and discrete
+    perturbations.
+
+    The cache lives in the process that uses it. When a comparator explains instances in forked worker processes,
+    every worker fills and counts on its own copy of the cache, so neither the cached rows nor the statistics of
+    the workers reach the cache of the parent process.
+    """
+
+    def __init__(self, pred_fn, maxsize: int = 10000):
+        """
+        :param pred_fn: prediction function taking a pandas DataFrame and returning an array with one row of
+            predictions per input row
+        :param maxsize: maximum number of cached rows, None for an unbounded cache
+        """
+        self.pred_fn = pred_fn
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __call__(self, data: pd.DataFrame) -> np.ndarray:
+        """
+        Predicts the given rows, only calling the wrapped prediction function for rows that are not cached
+
+        :param data: rows to predict
+        :return: predictions as numpy array
+        """
+        if not isinstance(data, pd.DataFrame):
+            data = pd.DataFrame(data)
+
+        keys = self.row_keys(data)
+        rows = [None] * len(keys)
+
+        # collect the positions of rows that need to be predicted, grouped by their values, rows with missing values
+        # have no key and are predicted one by one
+        missing = OrderedDict()
+        uncached = []
+        for position, key in enumerate(keys):
+            prediction = None if key is None else self._cache.get(key)
+            if prediction is not None:
+                self._cache.move_to_end(key)
+                rows[position] = prediction
+            elif key is None:
+                uncached.append(position)
+            else:
+                missing.setdefault(key, []).append(position)
+
+        if missing or uncached:
+            predictions = np.asarray(self.pred_fn(data.iloc[[positions[0] for positions in missing.values()] +
+                                                            uncached]))
+            for (key, positions), prediction in zip(missing.items(), predictions):
+                prediction = prediction.copy()
+                for position in positions:
+                    rows[position] = prediction
+                self._store(key, prediction)
+            for position, prediction in zip(uncached, predictions[len(missing):]):
+                rows[position] = prediction.copy()
+            self.misses += len(missing) + len(uncached)
+
+        self.hits += len(keys) - len(missing) - len(uncached)
+
+        if len(rows) == 0:
+            return np.asarray(self.pred_fn(data))
+        return np.stack(rows)
+
+    @staticmethod
+    def row_keys(data: pd.DataFrame) -> list:
+        """
+        Returns the cache key of every row of the given DataFrame, the tuple of its values. Numeric values are
+        converted to floats, so that the same row is recognized independent of whether an explainer passes it with
+        integer, float or object columns. Unlike a hash of the values, the keys of different rows never collide.
+        Rows with missing values have no key, as missing values never compare equal.
+
+        :param data: rows to identify
+        :return: list with one tuple per row, None for rows with missing values
+        """
+        columns = {}
+        for column in data.columns:
+            values = data[column]
+            if values.dtype == object:
+                try:
+                    values = pd.to_numeric(values)
+                except (ValueError, TypeError):
+                    pass
+            if pd.api.types.is_numeric_dtype(values.dtype) and not pd.api.types.is_bool_dtype(values.dtype):
+                values = values.astype(np.float64)
+            columns[column] = values
+        keys = pd.DataFrame(columns, index=data.index).itertuples(index=False, name=None)
+        return [None if incomplete else key for key, incomplete in zip(keys, data.isna().any(axis=1))]
+
+    def _store(self, key, prediction):
+        """
+        Adds a prediction to the cache and evicts the least recently used rows if the cache is full
+
+        :param key: key of the row
+        :param prediction: prediction of the row
+        """
+        self._cache[key] = prediction
+        if self.maxsize is not None:
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+                self.evictions += 1
+
+    def cache_info(self) -> CacheInfo:
+        """
+        Returns statistics about the cache
+
+        :return: named tuple of hits, misses, evictions, maxsize and currsize
+        """
+        return CacheInfo(self.hits, self.misses, self.evictions, self.maxsize, len(self._cache))
+
+    def cache_clear(self):
+        """
+        Removes all cached predictions and resets the statistics
+        """
+        self._cache.clear()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
@@ -4,33 +4,93 @@ from functools import partial
 import astrapia as ast
 
 _transferlist = []  # global variable keeping track of loaded transfer functions
+_compiled = {}  # explainer class -> (number of transfer functions it was compiled with, compiled transfer functions)
 
 
-def add_transfer(f):
+def add_transfer(f, vectorized=False, name=None):
     """
     Add a transfer function to the list of all global transfer functions.
 
+    A scalar transfer function receives the metric and utility functions it depends on. A vectorized transfer
+    function receives their values instead, e.g. whole distance or weight vectors, which it processes with numpy.
+    If the dependencies of both variants of a metric are available, the vectorized variant is used.
+
     :param f: The transfer function to add.
+    :param vectorized: whether the transfer function takes the values of its dependencies
+    :param name: name of the inferred metric, defaults to the name of the function
     """
     params = list(inspect.signature(f).parameters)  # use inspect to get the parameters of the function
-    _transferlist.append((params, f.__name__, lambda obj: f(
-        *[getattr(obj, req) for req in params])))  # add transfer function with dependencies
+    _transferlist.append((params, name or f.__name__, f, vectorized))  # add transfer function with dependencies
 
 
-def use_transfer(obj):
+def compile_transfers(cls):
     """
-    Use the transfer functions on an object. Will add new attributes to the object.
+    Compiles the transfer functions that apply to an explainer class into a list in topological order, i.e. every
+    transfer function comes after the transfer functions it depends on. The list is compiled once per class and
+    recompiled when further transfer functions are added.
+
+    In the first round, transfer functions can depend on the metrics and utilities of the class, in all further
+    rounds on its metrics and the inferred metrics of the previous rounds.
+
+    :param cls: explainer class
+    :return: list of tuples of the name, the parameter names, the transfer function and whether it is vectorized
+    """
+    compiled = _compiled.get(cls)
+    if compiled is not None and compiled[0] == len(_transferlist):
+        return compiled[1]
+
+    metrics = {name for name, tag in cls.tag_registry.items() if tag == 'metric'}
+    available = metrics | {name for name, tag in cls.tag_registry.items() if tag == 'utility'}
+    transfers = {}
+    while True:
+        for params, name, f, vectorized in _transferlist:
+            if set(params) <= available and name not in available:
+                if name in transfers and transfers[name][3] and not vectorized:
+                    continue
+                # otherwise a transfer function registered later under the same name replaces earlier ones
+                transfers.pop(name, None)
+                transfers[name] = (name, params, f, vectorized)
+        resolved = metrics | set(transfers)
+        if resolved == available:
+            break
+        available = resolved
+
+    _compiled[cls] = (len(_transferlist), list(transfers.values()))
+    return _compiled[cls][1]
+
 
-    :param obj: The object to use the transfer functions on.
+def resolve_transfers(obj):
     """
-    mu_identifiers = {x for x in dir(obj) if getattr(getattr(obj, x), 'tag', None) in ['metric', 'utility']}
+    Resolves the metrics the transfer functions infer for an explainer in one pass over its compiled transfer
+    functions, without changing the explainer.
 
-    old_mu_identifiers = {}
-    new_mu_identifiers = mu_identifiers
-    while new_mu_identifiers != old_mu_identifiers:
-        for transition in _transferlist:
-            if set(transition[0]) <= new_mu_identifiers and transition[1] not in new_mu_identifiers:
-                setattr(obj, transition[1], ast.metric(partial(transition[2], obj)))
+    :param obj: The explainer to infer the metrics of.
+    :return: dictionary with key: name of the inferred metric, value: metric function
+    """
+    inferred = {}
+
+    def infer(params, f, vectorized):
+        dependencies = [inferred[param] if param in inferred else getattr(obj, param) for param in params]
+        if vectorized:
+            dependencies = [dependency() for dependency in dependencies]
+        return f(*dependencies)
+
+    for name, params, f, vectorized in compile_transfers(type(obj)):
+        if any(param not in inferred and getattr(obj, param, None) is None for param in params):
+            # the explainer object does not provide a utility of its class, see Explainer.tagged
+            continue
+        # an inferred metric is as expensive as the most expensive metric it depends on
+        cost = max((getattr(inferred[param] if param in inferred else getattr(obj, param), 'cost', 'cheap')
+                    for param in params), key=ast.COSTS.index, default='cheap')
+        inferred[name] = ast.metric(partial(infer, params, f, vectorized), cost=cost)
+    return inferred
 
-        old_mu_identifiers = new_mu_identifiers
-        new_mu_identifiers = {x for x in dir(obj) if getattr(getattr(obj, x), 'tag', None) == 'metric'}
+
+def use_transfer(obj):
+    """
+    Use the transfer functions on an object. Will add new attributes to the object.
+
+    :param obj: The explainer to use the transfer functions on.
+    """
+    for name, f in resolve_transfers(obj).items():
+        obj.add_tagged(name, f)
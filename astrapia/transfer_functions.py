@@ -1,3 +1,6 @@
+import numpy as np
+
+
 def generate_default_transfer_functions(add_transfer):
     # normalized area
     def area_norm(area, get_explained_instance):
@@ -11,4 +14,10 @@ def generate_default_transfer_functions(add_transfer):
 
     add_transfer(furthest_distance)
 
+    # furthest distance from the distance vector of the neighborhood, preferred over the pairwise loop above
+    def furthest_distance_vectorized(get_neighborhood_distances):
+        return float(np.max(get_neighborhood_distances, initial=0))
+
+    add_transfer(furthest_distance_vectorized, vectorized=True, name='furthest_distance')
+
     # optional: add further default transfer functions here
@@ -1,3 +1,7 @@
+import warnings
+
+import numpy as np
+from scipy.stats import norm, qmc
 from sklearn import metrics
 import pandas as pd
 import astrapia as xb
@@ -19,6 +23,34 @@ def model_properties(y_test, modelpredictions, labels=[]):
         return metrics.classification_report(y_test, modelpredictions, labels=labels, output_dict=True)
 
 
+def onehot_codec(meta: xb.Dataset, columns=None) -> xb.encoding.OneHotCodec:
+    """
+    Returns the fitted one-hot codec of a dataset, or fits a new one if the metadata does not provide it.
+
+    :param meta: Astrapia Dataset metadata with categorical_features attribute
+    :param columns: feature names used to fit a new codec
+    :return: OneHotCodec
+    """
+    codec = getattr(meta, 'onehot', None)
+    if codec is None:
+        codec = xb.encoding.OneHotCodec(columns if columns is not None else meta.feature_names,
+                                        meta.categorical_features)
+    return codec
+
+
+def ordinal_codec(meta: xb.Dataset) -> xb.encoding.OrdinalCodec:
+    """
+    Returns the fitted ordinal codec of a dataset, or fits a new one if the metadata does not provide it.
+
+    :param meta: Astrapia Dataset metadata with feature_names and categorical_features attributes
+    :return: OrdinalCodec
+    """
+    codec = getattr(meta, 'ordinal', None)
+    if codec is None:
+        codec = xb.encoding.OrdinalCodec(meta.feature_names, meta.categorical_features)
+    return codec
+
+
 def onehot_encode(data: pd.DataFrame, meta: xb.Dataset) -> any:
     """
     One-hot encodes the dataframe.
@@ -27,13 +59,175 @@ def onehot_encode(data: pd.DataFrame, meta: xb.Dataset) -> any:
     :param meta: Astrapia Dataset metadata with categorical_features attribute
     :return: One-hot encoded DataFrame
     """
+    return onehot_codec(meta, data.columns).encode(data)
+
+
+def onehot_decode(data, meta: xb.Dataset) -> pd.DataFrame:
+    """
+    Decodes one-hot encoded data into the Astrapia Dataset format.
+
+    :param data: one-hot encoded DataFrame or numpy array
+    :param meta: Astrapia Dataset metadata with categorical_features attribute
+    :return: DataFrame in the Astrapia Dataset format
+    """
+    return onehot_codec(meta).decode(data)
+
+
+def euclidean_distances(data: np.ndarray, instance: np.ndarray, chunk_size: int = None) -> np.ndarray:
+    """
+    Computes the euclidean distance between every row of a matrix and a single instance in one vectorized pass.
+
+    :param data: float matrix with one row per data point
+    :param instance: the instance to compute the distances to
+    :param chunk_size: optional number of rows processed at once to bound the memory of the intermediate matrix
+    :return: numpy array with one distance per row
+    """
+    instance = np.asarray(instance, dtype=float)
+    if chunk_size is None:
+        chunk_size = max(1, data.shape[0])
+
+    distances = np.empty(data.shape[0])
+    for start in range(0, data.shape[0], chunk_size):
+        difference = data[start:start + chunk_size] - instance
+        distances[start:start + chunk_size] = np.sqrt(np.einsum('ij,ij->i', difference, difference))
+    return distances
+
+
+def explain_adaptively(sample, predict, explain, num_samples: int, min_samples: int, tolerance: float,
+                       label: int = 1, top_k: int = None) -> tuple:
+    """
+    Fits a lime surrogate model on a neighborhood that grows until the model converges. The neighborhood starts
+    with min_samples rows and doubles until the top_k features of the explained label keep their ranking and
+    their coefficients change by at most tolerance, or until it holds num_samples rows. Only the rows added by a
+    batch are predicted, so explanations that converge early call the model on fewer rows.
+
+    :param sample: function sampling a neighborhood of the given size, returning a tuple of the neighborhood in the
+        interpretable and in the original representation whose first row is the explained instance
+    :param predict: function predicting rows in the original representation
+    :param explain: function fitting the surrogate model on the neighborhood in both representations and its
+        predictions, returning the explanation
+    :param num_samples: maximum size of the neighborhood
+    :param min_samples: size of the first batch
+    :param tolerance: maximum absolute change of a top_k coefficient between two consecutive batches
+    :param label: label whose coefficients are compared
+    :param top_k: number of highest ranked features that have to be stable, None for all selected features
+    :return: tuple of the explanation and the size of the neighborhood it was fitted on
+    """
+    data, inverse = sample(min(min_samples, num_samples))
+    yss = np.asarray(predict(inverse))
+    previous = None
+    while True:
+        explanation = explain(data, inverse, yss)
+        # lime sorts the coefficients by their absolute value, so the first features are the highest ranked ones
+        current = dict(explanation.local_exp[label])
+        ranking = list(current)[:top_k]
+        if previous is not None and list(previous)[:top_k] == ranking and \
+                max((abs(previous[f] - current[f]) for f in ranking), default=0) <= tolerance:
+            break
+        if len(data) >= num_samples:
+            break
+
+        previous = current
+        # the first row of every sampled neighborhood is the instance, which is already part of the neighborhood
+        new_data, new_inverse = sample(min(len(data), num_samples - len(data)) + 1)
+        data = np.vstack([data, new_data[1:]])
+        inverse = np.vstack([inverse, new_inverse[1:]])
+        yss = np.vstack([yss, np.asarray(predict(new_inverse[1:]))])
+    return explanation, len(data)
+
+
+def quasi_random_uniform(sampler: str, num_samples: int, dimensions: int, random_state) -> np.ndarray:
+    """
+    Draws points of a scrambled low-discrepancy sequence, which cover the unit cube more evenly than pseudo-random
+    points and can be mapped through inverse CDFs like uniform samples. The scrambling is seeded from the given
+    random state, so consecutive calls return different point sets.
+
+    :param sampler: 'sobol' or 'halton'
+    :param num_samples: number of points
+    :param dimensions: dimensionality of the unit cube
+    :param random_state: numpy RandomState the scrambling is seeded from
+    :return: numpy array of shape (num_samples, dimensions) with values in the open unit interval
+    """
+    engines = {'sobol': qmc.Sobol, 'halton': qmc.Halton}
+    if sampler not in engines:
+        raise ValueError(f'Unknown sampler {sampler!r}, expected one of {sorted(engines)}')
+    engine = engines[sampler](max(1, dimensions), scramble=True, seed=random_state.randint(np.iinfo(np.int32).max))
+    with warnings.catch_warnings():
+        # Sobol points are only balanced for powers of two, prefixes of the sequence are still low-discrepancy
+        warnings.simplefilter('ignore', UserWarning)
+        points = engine.random(num_samples)[:, :dimensions]
+    eps = np.finfo(float).eps
+    return np.clip(points, eps, 1 - eps)
+
+
+def sample_size(half_width: float, population: int, confidence: float = 0.95) -> int:
+    """
+    Returns the size of a simple random sample whose estimate of a proportion lies within the given half-width of
+    the confidence interval, assuming the worst case proportion of 0.5 and correcting for the finite population
+
+    :param half_width: half-width of the confidence interval, e.g. 0.005 for +-0.5%
+    :param population: size of the population
+    :param confidence: confidence level of the interval
+    :return: sample size
+    """
+    z = norm.ppf(0.5 + confidence / 2)
+    size = z ** 2 * 0.25 / half_width ** 2
+    return int(min(population, np.ceil(size / (1 + (size - 1) / population))))
+
+
+def stratified_ranks(strata: np.ndarray, random_state=None) -> tuple:
+    """
+    Orders the rows of every stratum randomly, once for all stratified samples of a population. Taking the first
+    rows of every stratum in this order draws nested samples: the sample of a larger fraction contains the samples
+    of all smaller fractions, so that quantities computed for the rows of a sample can be reused when it grows.
+
+    :param strata: stratum of every row of the population
+    :param random_state: seed or numpy RandomState
+    :return: tuple of the stratum of every row numbered from 0, the rank of every row within its stratum and the
+        rows of every stratum in the order of their ranks
+    """
+    random_state = np.random.RandomState(random_state) if not isinstance(random_state, np.random.RandomState) \
+        else random_state
+    _, strata = np.unique(np.asarray(strata), return_inverse=True)
+    ranks = np.empty(len(strata), dtype=np.int64)
+    orders = []
+    for stratum in range(strata.max(initial=-1) + 1):
+        order = random_state.permutation(np.flatnonzero(strata == stratum))
+        ranks[order] = np.arange(len(order))
+        orders.append(order)
+    return strata, ranks, orders
 
-    transformed_df = data[list(set(data.columns) - set(meta.categorical_features))]
 
-    new_dfs = []
+def stratified_sample(strata: np.ndarray, ranks: np.ndarray, orders: list, fraction: float, rows: np.ndarray = None,
+                      replicates: int = 10) -> tuple:
+    """
+    Draws a stratified random sample with proportional allocation from the ranks of stratified_ranks: the first
+    rows of every stratum, at least two per replicate group where the stratum is large enough. Every sampled row is
+    weighted with the inverse of its inclusion probability, so that weighted sums over the sample estimate sums over
+    the population. The sample is split into replicate groups by rank, which are stratified samples themselves, so
+    that the standard error of any estimate can be derived from the spread of its values on the groups.
 
-    for feature in meta.categorical_features:
-        for label in meta.categorical_features[feature]:
-            new_dfs.append(pd.DataFrame({feature + '_' + str(label): (data[feature] == label).astype(int)}))
+    :param strata: stratum of every row as returned by stratified_ranks
+    :param ranks: rank of every row within its stratum as returned by stratified_ranks
+    :param orders: rows of every stratum as returned by stratified_ranks
+    :param fraction: sampled fraction of every stratum
+    :param rows: sorted rows the sample is restricted to, e.g. the rows of a neighborhood, None for the whole
+        population. The weighted sums over the sample then estimate sums over these rows.
+    :param replicates: number of replicate groups
+    :return: tuple of the sample as tuple of sorted row indices and weights, and the list of the replicate groups
+        in the same format
+    """
+    sizes = np.array([len(order) for order in orders], dtype=np.int64)
+    counts = np.minimum(sizes, np.maximum(2 * replicates, np.ceil(fraction * sizes))).astype(np.int64)
+    if rows is None:
+        sampled = np.sort(np.concatenate([order[:count] for order, count in zip(orders, counts)] +
+                                         [np.empty(0, dtype=np.int64)]))
+    else:
+        rows = np.asarray(rows, dtype=np.int64)
+        sampled = rows[ranks[rows] < counts[strata[rows]]]
+    stratum, group = strata[sampled], ranks[sampled] % replicates
 
-    return pd.concat([transformed_df] + new_dfs, axis=1)
+    # population size of the stratum divided by the number of its rows in the sample or in a replicate group of it
+    weights = sizes[stratum] / counts[stratum]
+    group_weights = sizes[stratum] / ((counts[stratum] - group + replicates - 1) // replicates)
+    return (sampled, weights), [(sampled[group == g], group_weights[group == g]) for g in range(replicates)]
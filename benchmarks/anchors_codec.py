@@ -0,0 +1,133 @@
+"""
+Benchmark of the ordinal codec used by the AnchorsExplainer.
+
+Compares the number of anchors per second of the AnchorsExplainer against a variant that uses the previous
+transforms (np.vectorize with a dict lookup and Series.map with a lambda per categorical feature).
+
+Run from the repository root:
+
+    PYTHONPATH=. python benchmarks/anchors_codec.py --rows 20000 --instances 20
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+import sklearn.ensemble
+
+import astrapia as xb
+from astrapia.explainers import AnchorsExplainer
+
+
+class LegacyAnchorsExplainer(AnchorsExplainer):
+    """
+    AnchorsExplainer with the transforms used before the ordinal codec
+    """
+
+    def transform_dataset(self, data, meta):
+        result = {
+            'labels': (meta.target == meta.target_names[-1]).astype(int).to_numpy().reshape((-1,)),
+            'class_names': meta.target_names,
+            'ordinal_features': [i for i, label in (enumerate(meta.feature_names)) if label not
+                                 in meta.categorical_features.keys()],
+            'categorical_features': [i for i, label in (enumerate(meta.feature_names)) if label
+                                     in meta.categorical_features.keys()],
+            'categorical_names': {idx: [str(x) for x in meta.categorical_features[feature]] for idx, feature
+                                  in enumerate(meta.feature_names) if feature in meta.categorical_features},
+            'feature_names': meta.feature_names,
+            'data': data.to_numpy()
+        }
+
+        for feature_idx in result['categorical_features']:
+            feature_map = {feature: idx for idx, feature in enumerate(result['categorical_names'][feature_idx])}
+            result['data'][:, feature_idx] = np.vectorize(lambda x: feature_map[str(x)])(result['data'][:, feature_idx])
+
+        return result
+
+    def inverse_transform_dataset(self, data, meta):
+        df = pd.DataFrame(data['data'], columns=meta.feature_names)
+        for feature_idx in [i for i, label in (enumerate(meta.data.keys())) if
+                            label in meta.categorical_features.keys()]:
+            df[meta.feature_names[feature_idx]] = df[meta.feature_names[feature_idx]].map(
+                lambda entry: meta.categorical_features[meta.feature_names[feature_idx]][entry])
+        return df
+
+    def explain_instance(self, instance):
+        instance = self.transform_dataset(instance, self.meta)
+        self.explanation = self.explainer.explain_instance(instance['data'][0], self.predictor,
+                                                           threshold=self.min_precision)
+        self.instance = instance['data'][0]
+        return self.explanation
+
+
+def make_dataset(rows, categorical, continuous, labels, seed=0):
+    """
+    Creates a synthetic binary classification dataset with categorical and continuous features
+
+    :param rows: number of training rows
+    :param categorical: number of categorical features
+    :param continuous: number of continuous features
+    :param labels: number of labels per categorical feature
+    :param seed: seed of the random number generator
+    :return: astrapia Dataset
+    """
+    rng = np.random.RandomState(seed)
+    categorical_features = {f'cat{i}': [f'value{j}' for j in range(labels)] for i in range(categorical)}
+
+    def sample(n):
+        columns = {f'num{i}': rng.normal(size=n).round(2) for i in range(continuous)}
+        columns.update({feature: rng.choice(values, n) for feature, values in categorical_features.items()})
+        data = pd.DataFrame(columns)
+        score = data[[f'num{i}' for i in range(continuous)]].sum(axis=1) + (data['cat0'] == 'value0') * 2
+        return data, pd.DataFrame({'target': np.where(score > 1, 'yes', 'no')})
+
+    data, target = sample(rows)
+    data_dev, target_dev = sample(rows // 10)
+    data_test, target_test = sample(rows // 10)
+    return xb.Dataset(data=data, feature_names=list(data.columns), categorical_features=categorical_features,
+                      target=target, target_names=['no', 'yes'], target_name='target', name='synthetic',
+                      data_dev=data_dev, target_dev=target_dev, data_test=data_test, target_test=target_test)
+
+
+def anchors_per_second(explainer_class, data, pred_fn, instances, seed):
+    """
+    Measures how many anchors the given explainer class computes per second
+
+    :return: tuple of setup time in seconds and anchors per second
+    """
+    start = time.perf_counter()
+    explainer = explainer_class(data, pred_fn, 0.9)
+    setup = time.perf_counter() - start
+
+    np.random.seed(seed)
+    start = time.perf_counter()
+    for index in range(instances):
+        explainer.explain_instance(data.data_test.iloc[[index]])
+    return setup, instances / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--categorical', type=int, default=8)
+    parser.add_argument('--continuous', type=int, default=6)
+    parser.add_argument('--labels', type=int, default=10)
+    parser.add_argument('--instances', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    data = make_dataset(args.rows, args.categorical, args.continuous, args.labels, args.seed)
+    model = sklearn.ensemble.RandomForestClassifier(n_estimators=20, max_depth=8, random_state=args.seed)
+    model.fit(xb.utils.onehot_encode(data.data, data), data.target.to_numpy().reshape(-1))
+
+    def pred_fn(x):
+        return model.predict_proba(xb.utils.onehot_encode(x, data))
+
+    for name, explainer_class in [('before (np.vectorize / Series.map)', LegacyAnchorsExplainer),
+                                  ('after (OrdinalCodec)', AnchorsExplainer)]:
+        setup, rate = anchors_per_second(explainer_class, data, pred_fn, args.instances, args.seed)
+        print(f'{name:36} setup {setup:7.3f}s   {rate:7.2f} anchors/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+Benchmark of the perturbation samplers of the LimeExplainer.
+
+Explains the same instances repeatedly with different seeds and reports the variance of the surrogate coefficients
+across the repetitions for pseudo-random and low-discrepancy neighborhoods of increasing size. Every perturbation
+is one row predicted by the model, so the variance times the neighborhood size compares how stable the
+explanations of the samplers are per model call (lower is better).
+
+Run from the repository root:
+
+    PYTHONPATH=. python benchmarks/lime_sampling.py --rows 5000 --instances 5 --repetitions 20
+"""
+import argparse
+import time
+
+import numpy as np
+import sklearn.ensemble
+
+import astrapia as xb
+from astrapia.explainers import LimeExplainer
+
+from anchors_codec import make_dataset
+
+
+def coefficient_variance(explainer, data, instances, num_samples, repetitions):
+    """
+    Measures the variance of the lime coefficients of label 1 across repeated explanations of the same instances
+
+    :return: tuple of the mean coefficient variance and the seconds per explanation
+    """
+    num_features = explainer.train.shape[1]
+    variances = []
+    start = time.perf_counter()
+    for index in range(instances):
+        coefficients = np.zeros((repetitions, num_features))
+        for repetition in range(repetitions):
+            # lime draws from the global random state if it is not given one
+            np.random.seed(repetition)
+            explanation = explainer.explain_instance(data.data_test.iloc[[index]], num_features=num_features,
+                                                     num_samples=num_samples)
+            for feature, coefficient in explanation.as_map()[1]:
+                coefficients[repetition, feature] = coefficient
+        variances.append(coefficients.var(axis=0).mean())
+    return np.mean(variances), (time.perf_counter() - start) / (instances * repetitions)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=5000)
+    parser.add_argument('--categorical', type=int, default=4)
+    parser.add_argument('--continuous', type=int, default=4)
+    parser.add_argument('--labels', type=int, default=5)
+    parser.add_argument('--instances', type=int, default=5)
+    parser.add_argument('--repetitions', type=int, default=20)
+    parser.add_argument('--samples', type=int, nargs='+', default=[256, 512, 1024, 2048])
+    parser.add_argument('--discretize', action='store_true')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    data = make_dataset(args.rows, args.categorical, args.continuous, args.labels, args.seed)
+    model = sklearn.ensemble.RandomForestClassifier(n_estimators=20, max_depth=8, random_state=args.seed)
+    model.fit(xb.utils.onehot_encode(data.data, data), data.target.to_numpy().reshape(-1))
+
+    def pred_fn(x):
+        return model.predict_proba(xb.utils.onehot_encode(x, data))
+
+    print(f'{"sampler":8} {"samples":>8} {"variance":>12} {"variance * calls":>17} {"s/explanation":>14}')
+    for sampler in ['random', 'sobol', 'halton']:
+        explainer = LimeExplainer(data, pred_fn, discretize_continuous=args.discretize, sampler=sampler)
+        for num_samples in args.samples:
+            variance, seconds = coefficient_variance(explainer, data, args.instances, num_samples,
+                                                     args.repetitions)
+            print(f'{sampler:8} {num_samples:8d} {variance:12.3e} {variance * num_samples:17.3e} {seconds:14.4f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.linear_model import LogisticRegression
+
+import astrapia as xb
+
+
+def make_frame(rng, n):
+    data = pd.DataFrame({
+        'age': rng.randint(18, 80, n).astype(float),
+        'color': rng.choice(['red', 'green', 'blue'], n),
+        'hours': rng.normal(40, 10, n).round(1),
+        'kind': rng.choice(['a', 'b'], n),
+    })
+    target = np.where((data.age > 40) & (data.color != 'red') | (data.hours > 50), 'yes', 'no')
+    return data, pd.DataFrame({'t': target})
+
+
+@pytest.fixture
+def dataset():
+    rng = np.random.RandomState(0)
+    (data, target), (data_dev, target_dev), (data_test, target_test) = [make_frame(rng, n) for n in (300, 50, 50)]
+    return xb.Dataset(data=data, feature_names=list(data.columns),
+                      categorical_features={'color': ['red', 'green', 'blue'], 'kind': ['a', 'b']},
+                      target=target, target_names=['no', 'yes'], target_name='t', name='toy',
+                      data_dev=data_dev, target_dev=target_dev, data_test=data_test, target_test=target_test)
+
+
+@pytest.fixture
+def predict_fn(dataset):
+    """
+    Returns the class probabilities of a logistic regression, a smooth model whose lime explanations converge early
+    """
+    train = xb.utils.onehot_encode(dataset.data, dataset)
+    model = LogisticRegression(max_iter=1000).fit(train, dataset.target.to_numpy().reshape(-1))
+    return lambda rows: model.predict_proba(xb.utils.onehot_encode(rows, dataset)[train.columns])
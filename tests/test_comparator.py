@@ -0,0 +1,16 @@
+import numpy as np
+
+from astrapia import explainers
+from astrapia.comparator import ExplainerComparator
+
+
+def test_parallel_pool_matches_serial(dataset, predict_fn):
+    results = []
+    for run, n_jobs in enumerate((1, 2, 2)):
+        # lime samples from numpy's global RNG, which every run leaves in another state
+        np.random.seed(run)
+        comparator = ExplainerComparator()
+        comparator.add_explainer(explainers.LimeExplainer(dataset, predict_fn, pool_size=1000), 'LIME')
+        comparator.explain_instances(dataset.data.iloc[:4], n_jobs=n_jobs, random_state=0, metrics=['accuracy'])
+        results.append([explanation.local_exp[1] for explanation in comparator.explanations['LIME'].values()])
+    assert results[0] == results[1] == results[2]
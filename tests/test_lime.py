@@ -0,0 +1,16 @@
+import numpy as np
+
+from astrapia import explainers
+
+
+def test_adaptive_lime_stops_before_num_samples(dataset, predict_fn):
+    np.random.seed(0)
+    explainer = explainers.LimeExplainer(dataset, predict_fn, discretize_continuous=False, tolerance=.05,
+                                         min_samples=250)
+    explainer.explain_instance(dataset.data.iloc[[0]], num_samples=5000)
+    assert explainer.samples < 5000
+
+
+def test_samples_used_only_reported_adaptively(dataset, predict_fn):
+    assert 'samples_used' not in explainers.LimeExplainer(dataset, predict_fn).metrics()
+    assert 'samples_used' in explainers.LimeExplainer(dataset, predict_fn, tolerance=.05).metrics()
@@ -0,0 +1,20 @@
+import numpy as np
+import pandas as pd
+
+import astrapia as xb
+
+
+def test_rows_with_missing_values_are_not_cached():
+    calls = []
+
+    def predict(data):
+        calls.append(len(data))
+        return np.column_stack([data['a'].fillna(-1).to_numpy(), np.ones(len(data))])
+
+    cache = xb.PredictionCache(predict)
+    data = pd.DataFrame({'a': [1., np.nan, 1., np.nan], 'b': ['x', 'y', 'x', 'y']})
+    first, second = cache(data), cache(data)
+    assert np.array_equal(first, second)
+    assert np.array_equal(first[:, 0], [1, -1, 1, -1])
+    assert calls == [3, 2]
+    assert cache.cache_info().currsize == 1
@@ -0,0 +1,47 @@
+from types import SimpleNamespace
+
+import numpy as np
+
+import astrapia as xb
+
+
+def explain_with(coefficients):
+    """
+    Returns a fake explain function whose surrogate model has the given coefficients on consecutive fits
+    """
+    fits = iter(coefficients)
+    return lambda data, inverse, yss: SimpleNamespace(local_exp={1: next(fits)})
+
+
+def sample(size):
+    return np.zeros((size, 2)), np.zeros((size, 2))
+
+
+def test_explain_adaptively_stops_when_stable():
+    predicted = []
+
+    def predict(rows):
+        predicted.append(len(rows))
+        return np.ones((len(rows), 2))
+
+    stable = [(0, .5), (1, -.3), (2, .1)]
+    _, samples = xb.utils.explain_adaptively(sample, predict, explain_with([stable, stable]), num_samples=5000,
+                                             min_samples=500, tolerance=.01)
+    assert samples == 1000
+    assert sum(predicted) == samples
+
+
+def test_explain_adaptively_compares_top_k_by_feature():
+    # the features below the top 2 swap places, which does not matter for their coefficients or the ranking
+    fits = [[(0, .5), (1, -.3), (2, .10), (3, .09)],
+            [(0, .5), (1, -.3), (3, .10), (2, .09)]]
+    _, samples = xb.utils.explain_adaptively(sample, lambda rows: np.ones((len(rows), 2)), explain_with(fits),
+                                             num_samples=5000, min_samples=500, tolerance=.01, top_k=2)
+    assert samples == 1000
+
+
+def test_explain_adaptively_grows_until_num_samples():
+    fits = [[(0, .5), (1, -.3)], [(1, -.6), (0, .5)], [(0, .9), (1, -.3)], [(1, -.6), (0, .5)]]
+    _, samples = xb.utils.explain_adaptively(sample, lambda rows: np.ones((len(rows), 2)), explain_with(fits),
+                                             num_samples=3000, min_samples=500, tolerance=.01)
+    assert samples == 3000